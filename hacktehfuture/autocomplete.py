@@ -0,0 +1,104 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Prefix lookup of users by email address and of groups by name.
+
+UserProfile and UserGroup keep a lowercased copy of the email address or
+name, set when they are saved.  A prefix is then one range query on that
+property, which the datastore answers from its built-in single property
+index, in order.  Results are cached by prefix until the next change to a
+user or group.  Users and groups saved before the copy existed are given it
+by the user-lookup and group-lookup migrations.
+
+"""
+
+import migrations
+import models
+import utility
+
+
+# Most matches returned for one prefix.
+MAX_MATCHES = 10
+
+# What can be looked up: the model and the property holding the lowercase copy.
+KINDS = {
+    'user': ('UserProfile', 'email_lower'),
+    'group': ('UserGroup', 'name_lower'),
+}
+
+
+def normalize(text):
+  """Returns the form of text that is stored and looked up."""
+  return (text or u'').strip().lower()
+
+
+def _to_dict(entity):
+  """Returns what the autocomplete endpoint sends for a user or group."""
+  if isinstance(entity, models.UserProfile):
+    return {'id': entity.key().id(), 'label': entity.email,
+            'value': entity.email}
+  return {'id': entity.key().id(), 'label': entity.name,
+          'value': entity.key().id()}
+
+
+def matches(kind, prefix, limit=MAX_MATCHES):
+  """Returns the users or groups whose email or name starts with a prefix.
+
+  Args:
+    kind: 'user' or 'group'
+    prefix: the text typed so far, in any case
+    limit: the largest number of matches to return
+
+  Returns:
+    A list of dicts with the id, label and value of each match, in order
+
+  """
+  prefix = normalize(prefix)
+  if not prefix or kind not in KINDS:
+    return []
+  limit = min(limit, MAX_MATCHES)
+
+  key = 'autocomplete:%s:%d:%s' % (kind, limit, prefix.encode('utf-8'))
+  result = utility.memcache_get(key)
+  if result is None:
+    model_name, property_name = KINDS[kind]
+    query = getattr(models, model_name).all()
+    query.filter('%s >=' % property_name, prefix)
+    query.filter('%s <' % property_name, prefix + u'\ufffd')
+    query.order(property_name)
+    result = [_to_dict(entity) for entity in query.fetch(limit)]
+    utility.memcache_set(key, result)
+  return result
+
+
+def _lowercase_transform(property_name):
+  """Returns a migration transform storing the lowercased copy."""
+
+  def transform(entity):
+    """Sets the copy, returning True if it was missing or out of date."""
+    old_value = getattr(entity, property_name)
+    entity.set_lowercase()
+    return getattr(entity, property_name) != old_value
+
+  return transform
+
+
+for _kind, (_model_name, _property_name) in KINDS.items():
+  migrations.register(
+      '%s-lookup' % _kind, _model_name, _lowercase_transform(_property_name),
+      'Stores the lowercased %s of %ss saved before autocomplete.' %
+      (_property_name.split('_')[0], _kind))
@@ -0,0 +1,109 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Migrations for data stored before the current storage formats.
+
+page-content moves the content of pages saved before PageContent existed
+out of the page.  page-content-compression compresses PageContent written
+before compression.  file-data-keys moves attachment data saved under a
+numeric id to its content-addressed FileStoreData, which also compresses it
+if the file is of a compressible type; data stored under a digest was
+written after compression was added, so it needs no separate pass.
+
+"""
+
+from google.appengine.ext import db
+import compression
+import migrations
+import models
+import utility
+
+
+# Attachments are read whole to re-key them, so fewer are migrated at once.
+FILE_BATCH_SIZE = 20
+
+
+def _has_legacy_content(page):
+  """Returns True if the content of a page is still stored inline."""
+  return (models.Page.content_data.get_value_for_datastore(page) is None and
+          page.legacy_content is not None)
+
+
+def _move_page_content(pages):
+  """Moves inline page content to new PageContent entities.
+
+  The content is written before the pages refer to it, so an interrupted
+  batch at worst leaves unreferenced PageContent behind.
+
+  """
+  contents = []
+  for page in pages:
+    page_content = models.PageContent()
+    page_content.text = page.legacy_content
+    contents.append(page_content)
+  db.put(contents)
+  for page, page_content in zip(pages, contents):
+    page.content_data = page_content
+    page.legacy_content = None
+  db.put(pages)
+
+
+def _compress_page_content(page_content):
+  """Compresses content stored uncompressed, returning True if it shrank."""
+  if page_content.encoding or not page_content.data:
+    return False
+  page_content.text = page_content.data
+  return page_content.encoding is not None
+
+
+def _has_numeric_data_key(file_store):
+  """Returns True if the data of a file is stored under a numeric id."""
+  key = file_store.data_key
+  return key is not None and models.FileStoreData.digest_of(key) is None
+
+
+def _rekey_file_data(files):
+  """Points files at content-addressed copies of their data.
+
+  The cache is cleared before the old data is released, since cached files
+  still refer to it.  A batch interrupted after acquiring the new data but
+  before saving the files takes another reference when it runs again, which
+  keeps that data stored after its last file is gone, but never loses it.
+
+  """
+  old_keys = []
+  for file_store in files:
+    old_keys.append(file_store.data_key)
+    file_store.blob_data = models.FileStoreData.acquire(
+        file_store.data, compression.is_compressible_name(file_store.name))
+  db.put(files)
+  utility.clear_memcache()
+  for key in old_keys:
+    models.FileStoreData.release(key)
+
+
+migrations.register(
+    'page-content', 'Page', _has_legacy_content,
+    'Moves the content of pages saved before PageContent into PageContent.',
+    save=_move_page_content)
+migrations.register(
+    'page-content-compression', 'PageContent', _compress_page_content,
+    'Compresses page content saved before compression.')
+migrations.register(
+    'file-data-keys', 'FileStore', _has_numeric_data_key,
+    'Moves attachment data saved under numeric ids to content-addressed, '
+    'compressed storage.', batch_size=FILE_BATCH_SIZE, save=_rekey_file_data)
@@ -0,0 +1,726 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Where cached data is kept.
+
+Every use of the cache goes through a CacheBackend, chosen by
+configuration.CACHE_BACKEND:
+
+  'appengine': the App Engine memcache.
+  'memcached': the memcached servers in configuration.MEMCACHED_SERVERS,
+      spread over with consistent hashing by the client, so that adding or
+      losing a server only moves the keys that were on it.  Needs the
+      python-memcached library.
+  'local': an LRU cache in the memory of each instance, for running a single
+      instance without a cache service.
+
+The methods follow the App Engine memcache API: misses read as None and
+failures are reported through return values rather than raised.  A shared
+backend is used through a FallbackBackend, which keeps values the shared
+cache refuses, such as ones over MAX_VALUE_SIZE, in an in-process cache, and
+turns to that cache for everything for configuration.CACHE_RETRY_TIME
+seconds when the shared cache cannot be reached at all.  Entries written to
+the in-process cache are only kept for configuration.CACHE_FALLBACK_TIME
+seconds, because edits made on other instances cannot invalidate them.
+
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+import configuration
+
+try:
+  import memcache as memcached_client  # pylint: disable-msg=F0401
+except ImportError:
+  memcached_client = None
+
+
+# Points each memcached server has on the hash ring.
+POINTS_PER_SERVER = 100
+
+# Longest key memcached accepts.
+_MAX_KEY_LENGTH = 250
+
+# Largest value, in bytes, that memcached and the App Engine memcache store.
+MAX_VALUE_SIZE = 1000000
+
+_shared = None
+_current = None
+
+
+def _new_stamp():
+  """Returns a generation stamp that differs from every earlier one."""
+  return repr(time.time())
+
+
+def _now():
+  """Returns the current time; for methods whose time argument hides it."""
+  return time.time()
+
+
+def _too_large(value):
+  """Returns True for a value the shared caches would refuse for its size."""
+  return isinstance(value, str) and len(value) > MAX_VALUE_SIZE
+
+
+class CacheBackend(object):
+  """A cache of values by string key.
+
+  Times are lifetimes in seconds, 0 meaning no expiry.  Subclasses implement
+  every method but generation and new_generation.
+
+  """
+
+  name = None
+
+  def get(self, key):
+    """Returns the value stored under key, or None."""
+    raise NotImplementedError
+
+  def get_multi(self, keys, key_prefix=''):
+    """Returns a dict of the values found for keys, by key without prefix."""
+    raise NotImplementedError
+
+  def set(self, key, value, time=0):
+    """Stores a value.
+
+    Returns:
+      True if the value was stored
+
+    """
+    raise NotImplementedError
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    """Stores every value of a dict.
+
+    Returns:
+      The list of keys whose values were not stored
+
+    """
+    raise NotImplementedError
+
+  def add(self, key, value, time=0):
+    """Stores a value unless the key is already present.
+
+    Returns:
+      True if the value was stored
+
+    """
+    raise NotImplementedError
+
+  def incr(self, key, delta=1):
+    """Adds delta to a stored integer.
+
+    Returns:
+      The new value, or None if the key is not present
+
+    """
+    raise NotImplementedError
+
+  def decr(self, key, delta=1):
+    """Subtracts delta from a stored integer, stopping at zero.
+
+    Returns:
+      The new value, or None if the key is not present
+
+    """
+    raise NotImplementedError
+
+  def delete(self, key):
+    """Removes a key."""
+    raise NotImplementedError
+
+  def delete_multi(self, keys):
+    """Removes every key in a list."""
+    raise NotImplementedError
+
+  def get_stats(self):
+    """Returns a dict of hits, misses, byte_hits, items, bytes and
+    oldest_item_age, leaving out what the backend does not know, or None if
+    the statistics cannot be read.
+
+    """
+    raise NotImplementedError
+
+  def generation(self, key):
+    """Returns the generation stamp stored under key, starting one if needed.
+
+    Entries tagged with the stamp are hidden by new_generation.  If the stamp
+    is evicted a new generation starts, which hides the same entries.
+
+    """
+    generation = self.get(key)
+    if generation is None:
+      generation = _new_stamp()
+      if not self.add(key, generation):
+        generation = self.get(key) or generation
+    return generation
+
+  def new_generation(self, key):
+    """Starts a new generation under key.
+
+    Returns:
+      The new stamp, or None if it could not be stored
+
+    """
+    generation = _new_stamp()
+    if self.set(key, generation):
+      return generation
+    return None
+
+
+class AppEngineBackend(CacheBackend):
+  """The App Engine memcache."""
+
+  # pylint: disable-msg=E1101
+  name = 'App Engine memcache'
+
+  def get(self, key):
+    return memcache.get(key)
+
+  def get_multi(self, keys, key_prefix=''):
+    return memcache.get_multi(keys, key_prefix=key_prefix)
+
+  def set(self, key, value, time=0):
+    return memcache.set(key, value, time=time)
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    return memcache.set_multi(mapping, time=time, key_prefix=key_prefix)
+
+  def add(self, key, value, time=0):
+    return memcache.add(key, value, time=time)
+
+  def incr(self, key, delta=1):
+    return memcache.incr(key, delta)
+
+  def decr(self, key, delta=1):
+    return memcache.decr(key, delta)
+
+  def delete(self, key):
+    memcache.delete(key)
+
+  def delete_multi(self, keys):
+    memcache.delete_multi(keys)
+
+  def get_stats(self):
+    return memcache.get_stats()
+
+
+class LocalBackend(CacheBackend):
+  """An LRU cache in the memory of this instance.
+
+  Entries are kept in a circular doubly linked list, least recently used
+  first, so that a hit and an eviction are both constant time.  Each link is
+  [previous, next, key, value, expiry, last access].
+
+  """
+
+  name = 'In-process cache'
+
+  def __init__(self, max_items, max_time=0):
+    """Initializes the cache.
+
+    Args:
+      max_items: how many entries are kept before the least recently used
+                 ones are evicted
+      max_time: longest lifetime of an entry in seconds, 0 for no limit
+
+    """
+    self.max_items = max_items
+    self.max_time = max_time
+    self._lock = threading.Lock()
+    self._links = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, None, None]
+    self._hits = self._misses = self._byte_hits = 0
+
+  def _unlink(self, link):
+    """Takes a link out of the list."""
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def _append(self, link):
+    """Puts a link at the most recently used end of the list."""
+    last = self._root[0]
+    link[0] = last
+    link[1] = self._root
+    last[1] = link
+    self._root[0] = link
+
+  def _lookup(self, key, now):
+    """Finds the live link of a key and marks it used; needs the lock."""
+    link = self._links.get(key)
+    if link is None:
+      return None
+    if link[4] and link[4] <= now:
+      self._unlink(link)
+      del self._links[key]
+      return None
+    self._unlink(link)
+    self._append(link)
+    link[5] = now
+    return link
+
+  def _store(self, key, value, time, now):
+    """Stores a value, evicting the oldest entry if full; needs the lock."""
+    if self.max_time:
+      time = min(time or self.max_time, self.max_time)
+    expires = time and now + time
+    link = self._links.get(key)
+    if link is None:
+      link = [None, None, key, value, expires, now]
+      self._links[key] = link
+      if len(self._links) > self.max_items:
+        oldest = self._root[1]
+        self._unlink(oldest)
+        del self._links[oldest[2]]
+    else:
+      self._unlink(link)
+      link[3:] = [value, expires, now]
+    self._append(link)
+
+  def _get(self, key, now):
+    """Returns a value and counts the hit or miss; needs the lock."""
+    link = self._lookup(key, now)
+    if link is None:
+      self._misses += 1
+      return None
+    self._hits += 1
+    if isinstance(link[3], str):
+      self._byte_hits += len(link[3])
+    return link[3]
+
+  def get(self, key):
+    self._lock.acquire()
+    try:
+      return self._get(key, time.time())
+    finally:
+      self._lock.release()
+
+  def get_multi(self, keys, key_prefix=''):
+    now = time.time()
+    found = {}
+    self._lock.acquire()
+    try:
+      for key in keys:
+        value = self._get(key_prefix + key, now)
+        if value is not None:
+          found[key] = value
+    finally:
+      self._lock.release()
+    return found
+
+  def set(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    self.set_multi({key: value}, time=time)
+    return True
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    # pylint: disable-msg=W0621
+    now = _now()
+    self._lock.acquire()
+    try:
+      for key, value in mapping.iteritems():
+        self._store(key_prefix + key, value, time, now)
+    finally:
+      self._lock.release()
+    return []
+
+  def add(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    now = _now()
+    self._lock.acquire()
+    try:
+      if self._lookup(key, now) is not None:
+        return False
+      self._store(key, value, time, now)
+      return True
+    finally:
+      self._lock.release()
+
+  def incr(self, key, delta=1):
+    now = time.time()
+    self._lock.acquire()
+    try:
+      link = self._lookup(key, now)
+      if link is None:
+        return None
+      link[3] = max(0, int(link[3]) + delta)
+      return link[3]
+    finally:
+      self._lock.release()
+
+  def decr(self, key, delta=1):
+    return self.incr(key, -delta)
+
+  def delete(self, key):
+    self.delete_multi([key])
+
+  def delete_multi(self, keys):
+    self._lock.acquire()
+    try:
+      for key in keys:
+        link = self._links.pop(key, None)
+        if link is not None:
+          self._unlink(link)
+    finally:
+      self._lock.release()
+
+  def get_stats(self):
+    self._lock.acquire()
+    try:
+      oldest = self._root[1]
+      return {
+          'hits': self._hits,
+          'misses': self._misses,
+          'byte_hits': self._byte_hits,
+          'items': len(self._links),
+          'bytes': sum([len(link[3]) for link in self._links.itervalues()
+                        if isinstance(link[3], str)]),
+          'oldest_item_age': oldest[5] and int(time.time() - oldest[5]),
+      }
+    finally:
+      self._lock.release()
+
+
+def _hash(value):
+  """Returns the position of a string on the hash ring."""
+  return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class MemcachedBackend(CacheBackend):
+  """Memcached servers, each holding the keys that hash to its part of a ring.
+
+  Every server has POINTS_PER_SERVER points on the ring and a key goes to the
+  server of the first point after the key's hash.  A server that refuses
+  every value of a write, as it does when it cannot be reached, is skipped
+  for configuration.CACHE_RETRY_TIME seconds, which moves its keys to the
+  servers that follow it on the ring.  Values over MAX_VALUE_SIZE are refused
+  without sending them and do not count against the server.
+
+  """
+
+  name = 'memcached'
+
+  def __init__(self, servers):
+    """Initializes the client.
+
+    Args:
+      servers: a sequence of 'host:port' strings
+
+    Raises:
+      ImportError: python-memcached is not installed
+
+    """
+    if memcached_client is None:
+      raise ImportError('python-memcached is needed to use memcached servers')
+    self._clients = dict((server, memcached_client.Client([server]))
+                         for server in servers)
+    ring = sorted((_hash('%s-%d' % (server, i)), server)
+                  for server in servers for i in range(POINTS_PER_SERVER))
+    self._points = [point for point, _ in ring]
+    self._servers = [server for _, server in ring]
+    self._down_until = {}
+
+  def _key(self, key):
+    """Returns a key memcached accepts for any key."""
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    if (len(key) > _MAX_KEY_LENGTH or
+        [char for char in key if ord(char) <= 32 or ord(char) == 127]):
+      key = 'md5:%s' % hashlib.md5(key).hexdigest()
+    return key
+
+  def _server(self, key):
+    """Returns the server a cleaned key belongs to, or None if all are down."""
+    if not self._points:
+      return None
+    now = time.time()
+    start = bisect.bisect(self._points, _hash(key))
+    for i in range(len(self._points)):
+      server = self._servers[(start + i) % len(self._points)]
+      if self._down_until.get(server, 0) <= now:
+        return server
+    return None
+
+  def _group(self, keys):
+    """Sorts keys by server.
+
+    Returns:
+      A dict from server to a dict from cleaned key to key
+
+    """
+    groups = {}
+    for key in keys:
+      clean = self._key(key)
+      server = self._server(clean)
+      if server is not None:
+        groups.setdefault(server, {})[clean] = key
+    return groups
+
+  def _client(self, key):
+    """Returns the cleaned key and the client of its server, or None."""
+    clean = self._key(key)
+    server = self._server(clean)
+    return clean, server and self._clients[server]
+
+  def _failed(self, server):
+    """Skips a server that could not be written to for a while."""
+    logging.warning('memcached server %s is failing', server)
+    self._down_until[server] = time.time() + configuration.CACHE_RETRY_TIME
+
+  def get(self, key):
+    clean, client = self._client(key)
+    return client and client.get(clean)
+
+  def get_multi(self, keys, key_prefix=''):
+    found = {}
+    keys = dict((key_prefix + key, key) for key in keys)
+    for server, cleaned in self._group(keys).iteritems():
+      values = self._clients[server].get_multi(cleaned.keys())
+      for clean, value in values.iteritems():
+        found[keys[cleaned[clean]]] = value
+    return found
+
+  def set(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    return not self.set_multi({key: value}, time=time)
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    # pylint: disable-msg=W0621
+    keys = dict((key_prefix + key, key) for key in mapping)
+    stored = set()
+    for server, cleaned in self._group(keys).iteritems():
+      values = dict((clean, mapping[keys[key]])
+                    for clean, key in cleaned.iteritems()
+                    if not _too_large(mapping[keys[key]]))
+      if not values:
+        continue
+      failed = self._clients[server].set_multi(values, time=time)
+      if len(failed) == len(values):
+        self._failed(server)
+      stored.update(keys[cleaned[clean]] for clean in values
+                    if clean not in failed)
+    return [key for key in mapping if key not in stored]
+
+  def add(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    clean, client = self._client(key)
+    return bool(client and client.add(clean, value, time=time))
+
+  def incr(self, key, delta=1):
+    clean, client = self._client(key)
+    return client and client.incr(clean, delta)
+
+  def decr(self, key, delta=1):
+    clean, client = self._client(key)
+    return client and client.decr(clean, delta)
+
+  def delete(self, key):
+    self.delete_multi([key])
+
+  def delete_multi(self, keys):
+    for server, cleaned in self._group(keys).iteritems():
+      self._clients[server].delete_multi(cleaned.keys())
+
+  def get_stats(self):
+    totals = {'hits': 0, 'misses': 0, 'items': 0, 'bytes': 0}
+    names = (('hits', 'get_hits'), ('misses', 'get_misses'),
+             ('items', 'curr_items'), ('bytes', 'bytes'))
+    for client in self._clients.itervalues():
+      for _, stats in client.get_stats():
+        for name, stat in names:
+          totals[name] += int(stats.get(stat, 0))
+    return totals
+
+
+class FallbackBackend(CacheBackend):
+  """A shared backend that is replaced by an in-process one while failing.
+
+  Values the shared backend refuses are kept in the in-process one, which
+  reads fall back to on a miss.  The shared backend is only taken to be
+  failing when it refuses every value of a write; a single value refused for
+  its size says nothing about the others.  Reads cannot tell a failure from a
+  miss, so they carry on going to it until then.
+
+  """
+
+  def __init__(self, primary, fallback):
+    """Initializes the backend.
+
+    Args:
+      primary: the shared CacheBackend
+      fallback: the LocalBackend used while the primary is failing
+
+    """
+    self.primary = primary
+    self.fallback = fallback
+    self.name = primary.name
+    self._down_until = 0
+
+  def _failed(self):
+    """Uses the fallback for a while, logging when it starts."""
+    now = time.time()
+    if self._down_until <= now:
+      logging.warning('%s is failing, using the in-process cache for %d '
+                      'seconds', self.primary.name,
+                      configuration.CACHE_RETRY_TIME)
+    self._down_until = now + configuration.CACHE_RETRY_TIME
+
+  def is_degraded(self):
+    """Returns True while the fallback is in use."""
+    return self._down_until > time.time()
+
+  def _active(self):
+    """Returns the backend to use now."""
+    if self.is_degraded():
+      return self.fallback
+    return self.primary
+
+  def get(self, key):
+    if self.is_degraded():
+      return self.fallback.get(key)
+    value = self.primary.get(key)
+    if value is None:
+      value = self.fallback.get(key)
+    return value
+
+  def get_multi(self, keys, key_prefix=''):
+    if self.is_degraded():
+      return self.fallback.get_multi(keys, key_prefix=key_prefix)
+    found = self.primary.get_multi(keys, key_prefix=key_prefix)
+    missing = [key for key in keys if key not in found]
+    if missing:
+      found.update(self.fallback.get_multi(missing, key_prefix=key_prefix))
+    return found
+
+  def set(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    return not self.set_multi({key: value}, time=time)
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    """Stores every value of a dict, keeping refused ones in-process.
+
+    Values that the shared backend stores are removed from the in-process
+    one, so that an older copy kept there is not read after they are evicted.
+
+    Returns:
+      The list of keys whose values were not stored
+
+    """
+    # pylint: disable-msg=W0621
+    if self.is_degraded():
+      return self.fallback.set_multi(mapping, time=time,
+                                     key_prefix=key_prefix)
+    sendable = dict((key, value) for key, value in mapping.iteritems()
+                    if not _too_large(value))
+    refused = set()
+    if sendable:
+      refused.update(self.primary.set_multi(sendable, time=time,
+                                            key_prefix=key_prefix))
+      if len(refused) == len(sendable):
+        self._failed()
+    self.fallback.delete_multi([key_prefix + key for key in sendable
+                                if key not in refused])
+    kept = dict((key, value) for key, value in mapping.iteritems()
+                if key in refused or key not in sendable)
+    return self.fallback.set_multi(kept, time=time, key_prefix=key_prefix)
+
+  def add(self, key, value, time=0):
+    # pylint: disable-msg=W0621
+    return self._active().add(key, value, time=time)
+
+  def incr(self, key, delta=1):
+    return self._active().incr(key, delta)
+
+  def decr(self, key, delta=1):
+    return self._active().decr(key, delta)
+
+  def delete(self, key):
+    self.delete_multi([key])
+
+  def delete_multi(self, keys):
+    self.fallback.delete_multi(keys)
+    if not self.is_degraded():
+      self.primary.delete_multi(keys)
+
+  def new_generation(self, key):
+    """Starts a new generation in both backends.
+
+    The shared backend is always tried, since other instances only see a new
+    generation there.
+
+    Returns:
+      The new stamp, or None if the shared backend did not store it
+
+    """
+    self.fallback.new_generation(key)
+    generation = self.primary.new_generation(key)
+    if generation is None:
+      self._failed()
+    return generation
+
+  def get_stats(self):
+    stats = dict(self.primary.get_stats() or {})
+    stats['degraded'] = self.is_degraded()
+    stats['fallback_items'] = self.fallback.get_stats()['items']
+    return stats
+
+
+def _make_backend():
+  """Creates the backend named by configuration.CACHE_BACKEND."""
+  if configuration.CACHE_BACKEND == 'local':
+    return LocalBackend(configuration.LOCAL_CACHE_SIZE)
+  if configuration.CACHE_BACKEND == 'memcached':
+    return MemcachedBackend(configuration.MEMCACHED_SERVERS)
+  return AppEngineBackend()
+
+
+def shared():
+  """Returns the configured backend, without the in-process fallback.
+
+  For data that is lost, rather than stale, if it is only kept by one
+  instance, such as pending counter hits.
+
+  """
+  global _shared  # pylint: disable-msg=W0603
+  if _shared is None:
+    _shared = _make_backend()
+  return _shared
+
+
+def current():
+  """Returns the backend for cached data.
+
+  Unless the configured backend is already in-process, it is wrapped in a
+  FallbackBackend.
+
+  """
+  global _current  # pylint: disable-msg=W0603
+  if _current is None:
+    backend = shared()
+    if not isinstance(backend, LocalBackend):
+      backend = FallbackBackend(
+          backend, LocalBackend(configuration.LOCAL_CACHE_SIZE,
+                                configuration.CACHE_FALLBACK_TIME))
+    _current = backend
+  return _current
@@ -0,0 +1,157 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Cache headers for pages and files, and purging them from proxies.
+
+Whether a response may be kept by shared caches follows from its ACL: pages
+and files anyone can read are public, everything else private.  A page also
+differs for signed-in users, so every page varies on the Cookie header, which
+carries the login, and only pages sent to anonymous users may be kept; a
+signed-in user's browser checks a page again every time it is shown, so an
+editor sees their change at once.
+
+Every response lists surrogate keys naming what it was built from: the page
+or file, each page above it, its ACL and, for pages, the version of the
+sidebar.  When one of those changes, its keys are posted to
+configuration.PURGE_URL by a task, once the change is written, so that a
+proxy can drop every response built from it.
+
+"""
+
+import datetime
+
+from django.core import urlresolvers
+from django.utils import cache
+from google.appengine.api import taskqueue
+import configuration
+import snapshot
+import unitofwork
+
+
+# Surrogate keys waiting to be purged once the current changes are written.
+_pending = set()
+
+
+def surrogate_keys(site, record):
+  """Returns the surrogate keys of a page or file.
+
+  Args:
+    site: the SiteSnapshot the record belongs to
+    record: a PageRecord or FileRecord
+
+  Returns:
+    A list of surrogate key strings
+
+  """
+  if isinstance(record, snapshot.FileRecord):
+    keys = ['file-%d' % record.id]
+    page = record.page
+  else:
+    keys = ['sidebar-%s' % site.sidebar_version]
+    page = record
+  while page is not None:
+    keys.append('page-%d' % page.id)
+    page = page.parent
+  if record.acl_id is not None:
+    keys.append('acl-%d' % record.acl_id)
+  return keys
+
+
+def set_headers(response, record, lifetime, per_user=False, signed_in=False):
+  """Sets the cache policy and surrogate keys of a response.
+
+  Args:
+    response: the HttpResponse sending a page or file
+    record: the PageRecord or FileRecord being sent
+    lifetime: a timedelta, how long the response may be cached for
+    per_user: True if the response differs once a user has signed in
+    signed_in: True if a user is signed in; only used with per_user
+
+  Returns:
+    The response
+
+  """
+  max_age = lifetime.days * 86400 + lifetime.seconds
+  site = snapshot.current()
+  if per_user:
+    cache.patch_vary_headers(response, ('Cookie',))
+  if per_user and signed_in:
+    response['Cache-Control'] = 'private, no-cache'
+  else:
+    if site.is_public(record):
+      response['Cache-Control'] = 'public, max-age=%d' % max_age
+    else:
+      response['Cache-Control'] = 'private, max-age=%d' % max_age
+      cache.patch_vary_headers(response, ('Cookie',))
+    expires = datetime.datetime.utcnow() + lifetime
+    response['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
+  response['Surrogate-Key'] = ' '.join(surrogate_keys(site, record))
+  return response
+
+
+def purge(keys):
+  """Asks the proxy to drop responses with any of the given surrogate keys.
+
+  The keys are collected and posted together once the current unit of work
+  is written.
+
+  Args:
+    keys: a list of surrogate key strings
+
+  """
+  if not configuration.PURGE_URL:
+    return
+  _pending.update(keys)
+  unitofwork.after_commit(_queue_purge)
+
+
+def _queue_purge():
+  """Queues a task posting the pending surrogate keys to the proxy."""
+  if not _pending:
+    return
+  keys = ' '.join(sorted(_pending))
+  _pending.clear()
+  taskqueue.add(url=urlresolvers.reverse('views.tasks.purge_cache'),
+                params={'keys': keys})
+
+
+def purge_entity(entity):
+  """Purges the responses built from a page, file, ACL or the sidebar.
+
+  The sidebar has to be purged before it is saved, while the snapshot still
+  has the version being replaced; everything else needs its key.
+
+  Args:
+    entity: the Page, FileStore, AccessControlList or Sidebar that changed
+
+  """
+  if not configuration.PURGE_URL:
+    return
+  kind = entity.kind()
+  if kind == 'Sidebar':
+    purge(['sidebar-%s' % snapshot.current().sidebar_version])
+  elif kind == 'FileStore':
+    keys = ['file-%d' % entity.key().id()]
+    page_key = entity.__class__.parent_page.get_value_for_datastore(entity)
+    if page_key is not None:
+      # The page lists its attachments.
+      keys.append('page-%d' % page_key.id())
+    purge(keys)
+  elif kind == 'Page':
+    purge(['page-%d' % entity.key().id()])
+  elif kind == 'AccessControlList':
+    purge(['acl-%d' % entity.key().id()])
@@ -0,0 +1,174 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Journal of changes to pages, files and access control lists.
+
+Every save or delete appends a ChangeRecord.  Reading the journal in
+timestamp order with a cursor gives the changes since the last read, which
+lets the admin pages and external mirrors catch up without crawling the site.
+
+"""
+
+import calendar
+import datetime
+
+from google.appengine.ext import db
+import models
+
+
+PUT = 'put'
+DELETE = 'delete'
+
+# Kinds of entity recorded in the journal.
+KINDS = ('Page', 'FileStore', 'AccessControlList')
+
+# Largest number of changes returned by one call to changes_since.
+MAX_CHANGES = 100
+
+
+class ChangeRecord(db.Model):
+  # pylint: disable-msg=R0904
+  """One save or delete of a Page, FileStore or AccessControlList.
+
+  For an ACL, path is that of the page the ACL belongs to, since every page
+  beneath it may have changed visibility.
+
+  """
+
+  kind = db.StringProperty(required=True, choices=KINDS)
+  entity_id = db.IntegerProperty(required=True)
+  action = db.StringProperty(required=True, choices=(PUT, DELETE))
+  name = db.StringProperty(indexed=False)
+  path = db.StringProperty(indexed=False)
+  # Taken as the record is written rather than when it is made, since
+  # records wait for the unit of work or a task; a poll that already read
+  # past a later time would otherwise never see them.
+  timestamp = db.DateTimeProperty(auto_now=True)
+
+  def to_dict(self):
+    """Returns the record as a dict suitable for JSON encoding."""
+    return {'kind': self.kind,
+            'id': self.entity_id,
+            'action': self.action,
+            'name': self.name,
+            'path': self.path,
+            'timestamp': to_seconds(self.timestamp)}
+
+
+def to_seconds(timestamp):
+  """Converts a UTC datetime into seconds since the epoch."""
+  return (calendar.timegm(timestamp.utctimetuple()) +
+          timestamp.microsecond / 1000000.0)
+
+
+def from_seconds(seconds):
+  """Converts seconds since the epoch into a UTC datetime."""
+  return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def record(entity, action):
+  """Appends an entry for a saved or deleted entity to the journal.
+
+  Args:
+    entity: the Page, FileStore or AccessControlList that changed
+    action: PUT or DELETE
+
+  """
+  new_record(entity, action).put()
+
+
+def new_record(entity, action):
+  """Returns an unsaved journal entry, for saving in a batch with the entity.
+
+  Args:
+    entity: the Page, FileStore or AccessControlList that changed; it must
+        already have a complete key
+    action: PUT or DELETE
+
+  Returns:
+    A ChangeRecord
+
+  """
+  kind = entity.kind()
+  name = None
+  path = None
+  if kind == 'AccessControlList':
+    owner = models.Page.all().filter('acl_data =', entity).get()
+    if owner is not None:
+      name = owner.name
+      path = owner.path
+  else:
+    name = entity.name
+    path = entity.path
+  return ChangeRecord(kind=kind, entity_id=entity.key().id(), action=action,
+                      name=name, path=path)
+
+
+def changes_since(cursor=None, since=None, kind=None, limit=MAX_CHANGES):
+  """Returns changes in the order they were made.
+
+  A cursor only applies to the query that produced it, so calls continuing
+  from a cursor must pass the same since and kind as the first call.
+
+  Args:
+    cursor: cursor returned by a previous call, to continue from there
+    since: datetime to start after, or None for the start of the journal
+    kind: only return changes to this kind of entity, or None for all kinds
+    limit: the largest number of changes to return, at least 1
+
+  Returns:
+    A tuple of the list of ChangeRecord objects and a cursor to pass to the
+    next call.  The cursor stays valid once the journal is exhausted, so it
+    can be kept to poll for later changes.
+
+  """
+  query = ChangeRecord.all()
+  if kind:
+    query.filter('kind =', kind)
+  if since is not None:
+    query.filter('timestamp >', since)
+  if cursor:
+    query.with_cursor(cursor)
+  query.order('timestamp')
+  records = query.fetch(max(1, min(limit, MAX_CHANGES)))
+  return records, query.cursor()
+
+
+def recent_changes(cursor=None, kind=None, limit=MAX_CHANGES):
+  """Returns changes newest first.
+
+  Args:
+    cursor: cursor returned by a previous call, to fetch the next page
+    kind: only return changes to this kind of entity, or None for all kinds
+    limit: the largest number of changes to return
+
+  Returns:
+    A tuple of the list of ChangeRecord objects and a cursor for the next
+    page, or None if there are no older changes
+
+  """
+  limit = min(limit, MAX_CHANGES)
+  query = ChangeRecord.all()
+  if kind:
+    query.filter('kind =', kind)
+  if cursor:
+    query.with_cursor(cursor)
+  query.order('-timestamp')
+  records = query.fetch(limit)
+  if len(records) < limit:
+    return records, None
+  return records, query.cursor()
@@ -0,0 +1,109 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Gzip helpers for stored content and responses.
+
+Content is compressed in the gzip format rather than as a bare deflate
+stream so that the stored bytes can be sent unchanged to any client that
+accepts gzip.
+
+"""
+
+import cStringIO
+import gzip
+import mimetypes
+
+
+# Encoding flag stored alongside compressed data.
+GZIP = 'gzip'
+
+# Responses smaller than this many bytes are not worth compressing.
+MIN_RESPONSE_SIZE = 1024
+
+# Mime types that are worth compressing in addition to text/*.
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/msword',
+    'application/postscript',
+    'application/rtf',
+    'application/x-javascript',
+    'application/xhtml+xml',
+    'application/xml',
+    'image/svg+xml',
+])
+
+
+def is_compressible_type(mimetype):
+  """Determines if content of a mime type is likely to compress well."""
+  if not mimetype:
+    return False
+  mimetype = mimetype.split(';')[0].strip().lower()
+  return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def is_compressible_name(file_name):
+  """Determines if a file is likely to compress well from its name."""
+  return is_compressible_type(mimetypes.guess_type(file_name)[0])
+
+
+def compress(data):
+  """Compresses a string of bytes in the gzip format."""
+  buf = cStringIO.StringIO()
+  gzip_file = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=6)
+  gzip_file.write(data)
+  gzip_file.close()
+  return buf.getvalue()
+
+
+def decompress(data):
+  """Decompresses a string of bytes written by compress()."""
+  return gzip.GzipFile(mode='rb', fileobj=cStringIO.StringIO(data)).read()
+
+
+def maybe_compress(data):
+  """Compresses data if that makes it smaller.
+
+  Args:
+    data: the bytes to store
+
+  Returns:
+    A tuple of the bytes to store and GZIP, or the original bytes and None
+
+  """
+  if data:
+    compressed = compress(data)
+    if len(compressed) < len(data):
+      return compressed, GZIP
+  return data, None
+
+
+def accepts_gzip(request):
+  """Determines if the client accepts gzip encoded responses."""
+  for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+    params = coding.split(';')
+    if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+      continue
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
@@ -29,10 +29,59 @@ FOOTER_HTML = (
     'App Engine Site Creator</a> ')
 
 
-# File caching controls
-FILE_CACHE_CONTROL = 'private, max-age=86400'
+# File caching controls; whether caching is public follows from the ACL
 FILE_CACHE_TIME = datetime.timedelta(days=1)
 
+# Resized images are remade when the original changes, so keep them longer
+VARIANT_CACHE_TIME = datetime.timedelta(days=30)
+
+# Number of seconds a path that failed to resolve is remembered as missing
+MISSING_PATH_CACHE_TIME = 60
+
+# Time browsers and shared caches may keep a page anyone can read; pages
+# shown to signed-in users are fetched again every time
+PAGE_CACHE_TIME = datetime.timedelta(minutes=5)
+
+# Limits on how often one client can call expensive URLs.  Each rule is
+# (URL path pattern, 'ip' or 'user', requests allowed per period, seconds in
+# the period, HTTP statuses of the responses counted or None for every
+# request).  'user' limits signed-in users individually and everyone else by
+# address.
+RATE_LIMITS = (
+    (r'^/_treedata/$', 'user', 30, 60, None),
+    (r'^/admin/exportusers/$', 'user', 5, 60, None),
+    (r'^/admin/download/', 'user', 10, 60, None),
+    # Paths that do not exist, as requested by crawlers probing the site.
+    (r'^/', 'ip', 60, 60, (404,)),
+)
+
+# URL that is posted the surrogate keys of content that changed, so that a
+# proxy in front of the site can purge it, or None to purge nothing
+PURGE_URL = None
+
+# Where cached data is kept: 'appengine' for the App Engine memcache,
+# 'memcached' for the servers in MEMCACHED_SERVERS, or 'local' for a cache in
+# the memory of each instance, which only suits running a single instance
+CACHE_BACKEND = 'appengine'
+
+# 'host:port' of each memcached server, for CACHE_BACKEND = 'memcached'
+MEMCACHED_SERVERS = ()
+
+# Entries kept by an in-process cache
+LOCAL_CACHE_SIZE = 1000
+
+# Seconds a failing cache, or memcached server, is left alone before it is
+# tried again
+CACHE_RETRY_TIME = 30
+
+# Seconds entries are kept in the in-process cache while the shared cache is
+# failing, which bounds how long an instance can miss edits made elsewhere
+CACHE_FALLBACK_TIME = 30
+
+# Rows per page of the admin user and group listings, by default and at most
+LISTING_PAGE_SIZE = 50
+LISTING_MAX_PAGE_SIZE = 500
+
 
 # Title for the website
 SYSTEM_TITLE = 'App Engine Site Creator'
@@ -0,0 +1,193 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""View and download counters.
+
+A hit only increments a memcache counter, so counting adds no datastore
+work to the request.  The first hit on a counter since it was last flushed
+also appends the counter's name to a list of dirty counters.  flush(), run
+from cron, moves the pending hits of every dirty counter into CounterShard
+entities.  Each counter is spread over COUNTER_SHARDS entities so that the
+direct writes made when the memcache is unavailable do not contend.
+
+Hits still pending in the memcache are lost if it evicts them.  They are
+kept in the shared cache backend without its in-process fallback, since hits
+counted by one instance alone would never be flushed.
+
+"""
+
+import logging
+import random
+
+from google.appengine.ext import db
+import cachebackend
+import utility
+
+
+# Number of entities each counter is spread across.
+COUNTER_SHARDS = 20
+
+# Seconds the aggregated totals are cached for.
+REPORT_CACHE_TIME = 600
+
+# Most dirty counters handled by one flush.
+MAX_FLUSH = 500
+
+_PENDING_PREFIX = 'counter-pending:'
+_SLOT_PREFIX = 'counter-slot:'
+_INDEX_KEY = 'counter-index'
+_FLUSHED_KEY = 'counter-flushed'
+_LOCK_KEY = 'counter-flush-lock'
+
+
+class CounterShard(db.Model):
+  # pylint: disable-msg=R0904
+  """Part of the count of hits on a page or file.
+
+  The key name is '<kind>:<entity id>:<shard>'; the total is the sum of
+  count over all of the shards.
+
+  """
+
+  kind = db.StringProperty(required=True)
+  entity_id = db.IntegerProperty(required=True)
+  count = db.IntegerProperty(default=0, indexed=False)
+
+
+def _counter_name(kind, entity_id):
+  """Returns the name of the counter of an entity."""
+  return '%s:%d' % (kind, entity_id)
+
+
+def _add_to_shard(name, delta):
+  """Adds to a randomly chosen shard of a counter in a transaction."""
+  kind, entity_id = name.split(':')
+  key_name = '%s:%d' % (name, random.randint(0, COUNTER_SHARDS - 1))
+
+  def txn():
+    """Increments the shard, creating it if needed."""
+    shard = CounterShard.get_by_key_name(key_name)
+    if shard is None:
+      shard = CounterShard(key_name=key_name, kind=kind,
+                           entity_id=int(entity_id))
+    shard.count += delta
+    shard.put()
+
+  db.run_in_transaction(txn)
+
+
+def hit(kind, entity_id):
+  """Records a hit on a page or file.
+
+  Args:
+    kind: 'Page' or 'FileStore'
+    entity_id: the id of the entity that was viewed or downloaded
+
+  """
+  cache = cachebackend.shared()
+  name = _counter_name(kind, entity_id)
+  key = _PENDING_PREFIX + name
+  count = cache.incr(key)
+  if count is None:
+    if cache.add(key, 1):
+      count = 1
+    else:
+      count = cache.incr(key)
+
+  if count is None:
+    logging.warning('Memcache unavailable, counting %s directly', name)
+    _add_to_shard(name, 1)
+  elif count == 1:
+    _mark_dirty(name)
+
+
+def _mark_dirty(name):
+  """Adds a counter to the list of counters with pending hits."""
+  cache = cachebackend.shared()
+  index = cache.incr(_INDEX_KEY)
+  if index is None:
+    cache.add(_INDEX_KEY, 0)
+    index = cache.incr(_INDEX_KEY)
+  if index is not None:
+    cache.set('%s%d' % (_SLOT_PREFIX, index), name)
+
+
+def flush():
+  """Moves pending hits from the memcache into the datastore.
+
+  Returns:
+    The number of counters updated
+
+  """
+  cache = cachebackend.shared()
+  if not cache.add(_LOCK_KEY, 1, time=60):
+    return 0
+  try:
+    top = cache.get(_INDEX_KEY) or 0
+    flushed = cache.get(_FLUSHED_KEY) or 0
+    if flushed > top:
+      # The index was evicted and has started again.
+      flushed = 0
+    top = min(top, flushed + MAX_FLUSH)
+
+    slot_keys = ['%s%d' % (_SLOT_PREFIX, index)
+                 for index in range(flushed + 1, top + 1)]
+    names = set(cache.get_multi(slot_keys).values())
+    pending = cache.get_multi(list(names), key_prefix=_PENDING_PREFIX)
+
+    counts = [(name, int(count)) for name, count in pending.iteritems()
+              if int(count) > 0]
+    for name, count in counts:
+      # Each shard is read and written in a transaction, since a direct hit
+      # from _add_to_shard may update the same shard concurrently.
+      _add_to_shard(name, count)
+
+    cache.set(_FLUSHED_KEY, top)
+    cache.delete_multi(slot_keys)
+    for name, count in counts:
+      # Only what was flushed is subtracted; hits since the read stay pending
+      # and need a new slot, since the counter will not go from 0 to 1.
+      if cache.decr(_PENDING_PREFIX + name, count):
+        _mark_dirty(name)
+    return len(counts)
+  finally:
+    cache.delete(_LOCK_KEY)
+
+
+def totals(kind, limit=20):
+  """Returns the entities of a kind with the most hits.
+
+  Only hits that have been flushed are included.
+
+  Args:
+    kind: 'Page' or 'FileStore'
+    limit: how many entities to return
+
+  Returns:
+    A list of (entity id, total hits) tuples, most hits first
+
+  """
+  key = 'counter-totals:%s:%d' % (kind, limit)
+  result = utility.memcache_get(key)
+  if result is None:
+    sums = {}
+    for shard in CounterShard.all().filter('kind =', kind):
+      sums[shard.entity_id] = sums.get(shard.entity_id, 0) + shard.count
+    result = sorted(sums.items(), key=lambda item: item[1], reverse=True)
+    result = result[:limit]
+    utility.memcache_set(key, result, expires=REPORT_CACHE_TIME)
+  return result
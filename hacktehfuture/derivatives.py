@@ -0,0 +1,135 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Resized variants of image attachments.
+
+An image attachment can be requested at one of the sizes in SIZES by adding
+a size parameter to its URL.  The variant is made with the images API the
+first time it is asked for and stored as a FileStoreVariant, a child of the
+original FileStoreData.  Stored data never changes, since it is addressed
+by its contents, so variants only go away when the original data is deleted.
+
+"""
+
+import logging
+
+from google.appengine.api import images
+from google.appengine.ext import db
+
+
+# Largest width and height of each variant, in pixels.
+SIZES = {
+    'thumbnail': 100,
+    'medium': 400,
+}
+
+# Not every version of the images API can write WebP.
+WEBP = getattr(images, 'WEBP', None)
+
+_WEBP_SUFFIX = '.webp'
+
+
+class FileStoreVariant(db.Model):
+  # pylint: disable-msg=R0904
+  """A resized copy of an image attachment.
+
+  The parent is the FileStoreData holding the original image and the key name
+  is the size, with _WEBP_SUFFIX added for WebP variants.  A variant without
+  data records that the original is to be sent, because it is already small
+  enough or could not be resized.
+
+  """
+
+  data = db.BlobProperty()
+  mimetype = db.StringProperty(indexed=False)
+
+
+def accepts_webp(request):
+  """Determines if WebP variants can be sent in reply to a request."""
+  return (WEBP is not None and
+          'image/webp' in request.META.get('HTTP_ACCEPT', ''))
+
+
+def _variant_key(data_key, size, webp):
+  """Returns the key of a variant of the given FileStoreData."""
+  key_name = size
+  if webp:
+    key_name += _WEBP_SUFFIX
+  return db.Key.from_path('FileStoreVariant', key_name, parent=data_key)
+
+
+def _make_variant(key, data, mimetype, size, webp):
+  """Resizes an image and stores the result.
+
+  Returns:
+    The new FileStoreVariant
+
+  """
+  variant = FileStoreVariant(key=key)
+  max_size = SIZES[size]
+  try:
+    image = images.Image(data)
+    if image.width > max_size or image.height > max_size:
+      image.resize(width=max_size, height=max_size)
+      if webp:
+        output_encoding, mimetype = WEBP, 'image/webp'
+      elif mimetype == 'image/jpeg':
+        output_encoding = images.JPEG
+      else:
+        output_encoding, mimetype = images.PNG, 'image/png'
+      variant.data = db.Blob(
+          image.execute_transforms(output_encoding=output_encoding))
+      variant.mimetype = mimetype
+  except images.Error, err:
+    logging.warning('Could not make %s variant of %s: %s', size, key, err)
+  variant.put()
+  return variant
+
+
+def get_variant(file_store, mimetype, size, webp=False):
+  """Returns a resized variant of an image attachment, making it if needed.
+
+  Args:
+    file_store: the FileStore holding the image
+    mimetype: the mime type of the original image
+    size: one of the keys of SIZES
+    webp: True to get the variant in WebP format
+
+  Returns:
+    A FileStoreVariant, or None if the original should be sent instead
+
+  """
+  if size not in SIZES or not mimetype or not mimetype.startswith('image/'):
+    return None
+  # Only the key is needed unless the variant has to be made.
+  data_key = file_store.data_key
+  if data_key is None:
+    return None
+
+  key = _variant_key(data_key, size, webp)
+  variant = FileStoreVariant.get(key)
+  if variant is None:
+    variant = _make_variant(key, file_store.data, mimetype, size, webp)
+  if variant.data is None:
+    return None
+  return variant
+
+
+def delete_variants(data_key):
+  """Deletes every variant of the given FileStoreData."""
+  db.delete([_variant_key(data_key, size, webp)
+             for size in SIZES for webp in (False, True)])
@@ -17,8 +17,13 @@
 
 """Forms referenced by the views."""
 
+import django
 from django import forms
 from django.utils import translation
+
+# Work-around to avoid warning about django.newforms in djangoforms.
+django.newforms = forms
+
 from google.appengine.ext.db import djangoforms
 import models
 import validators
@@ -63,7 +68,7 @@ class GroupEditForm(djangoforms.ModelForm):
     # pylint: disable-msg=R0903
     """Django instruction to link the form to UserGroup model."""
     model = models.UserGroup
-    exclude = ['users']
+    exclude = ['users', 'name_lower']
 
 
 class UserEditForm(djangoforms.ModelForm):
@@ -80,4 +85,4 @@ class UserEditForm(djangoforms.ModelForm):
     # pylint: disable-msg=R0903
     """Django instruction to link the form to UserProfile model."""
     model = models.UserProfile
-    exclude = ['email']
+    exclude = ['email', 'email_lower']
@@ -0,0 +1,191 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Paged listings of users and groups for the admin pages.
+
+Each page is read from where the previous one stopped with a query cursor,
+and only the fields the listings display are cached, keyed by the cursor
+and the page size.  Saving a user, group or membership invalidates the
+cache, so a cached page never outlives the data it was read from.
+
+"""
+
+import hashlib
+
+from google.appengine.ext import db
+import configuration
+import models
+import utility
+
+
+# Prefix of the cursors of pages of members still listed in UserGroup.users.
+LEGACY_CURSOR_PREFIX = 'legacy:'
+
+
+def page_size(value):
+  """Returns the page size requested, within the allowed range.
+
+  Args:
+    value: the size parameter of the request, or None for the default
+
+  Returns:
+    The number of rows to show per page
+
+  """
+  try:
+    size = int(value)
+  except (TypeError, ValueError):
+    return configuration.LISTING_PAGE_SIZE
+  return max(1, min(size, configuration.LISTING_MAX_PAGE_SIZE))
+
+
+def _cached_page(name, cursor, size, read_page):
+  """Returns a page of a listing from the cache, reading it if needed.
+
+  Args:
+    name: identifies the listing
+    cursor: the cursor the page starts at, or None for the first page
+    size: the number of rows per page
+    read_page: called with cursor and size to read the page on a miss
+
+  Returns:
+    A tuple of the list of rows and the cursor of the next page, or None if
+    this is the last page
+
+  """
+  key = 'listing:%s:%d:%s' % (name, size,
+                              hashlib.md5(cursor or '').hexdigest())
+  result = utility.memcache_get(key)
+  if result is None:
+    result = read_page(cursor, size)
+    utility.memcache_set(key, result)
+  return result
+
+
+def _read_query_page(query, cursor, size):
+  """Fetches a page of a query from a cursor.
+
+  Returns:
+    A tuple of the results and the cursor of the next page, or None
+
+  """
+  if cursor:
+    query.with_cursor(cursor)
+  results = query.fetch(size)
+  if len(results) < size:
+    return results, None
+  return results, query.cursor()
+
+
+def users_page(cursor=None, size=configuration.LISTING_PAGE_SIZE):
+  """Returns a page of every user, ordered by email address.
+
+  Returns:
+    A tuple of a list of {'email'} dicts and the cursor of the next page
+
+  """
+
+  def read_page(cursor, size):
+    """Reads the users from the datastore."""
+    query = models.UserProfile.all().order('email')
+    profiles, next_cursor = _read_query_page(query, cursor, size)
+    return [{'email': profile.email} for profile in profiles], next_cursor
+
+  return _cached_page('users', cursor, size, read_page)
+
+
+def groups_page(cursor=None, size=configuration.LISTING_PAGE_SIZE):
+  """Returns a page of every group, ordered by name.
+
+  Returns:
+    A tuple of a list of {'id', 'name', 'description'} dicts and the cursor
+    of the next page
+
+  """
+
+  def read_page(cursor, size):
+    """Reads the groups from the datastore."""
+    query = models.UserGroup.all().order('name')
+    groups, next_cursor = _read_query_page(query, cursor, size)
+    return [{'id': group.key().id(), 'name': group.name,
+             'description': group.description}
+            for group in groups], next_cursor
+
+  return _cached_page('groups', cursor, size, read_page)
+
+
+def members_page(group, cursor=None, size=configuration.LISTING_PAGE_SIZE):
+  """Returns a page of the members of a group.
+
+  The members are read from the keys of their memberships, so only the
+  profiles on the page are fetched.  They are sorted by email address within
+  the page.  Members of a group that the migrate_group_members task has not
+  moved out of UserGroup.users yet are listed first, from that list, with a
+  cursor of LEGACY_CURSOR_PREFIX and their position in it.
+
+  Args:
+    group: the UserGroup to list
+    cursor: the cursor the page starts at, or None for the first page
+    size: the number of members per page
+
+  Returns:
+    A tuple of a list of {'email'} dicts and the cursor of the next page
+
+  """
+  legacy_keys = group.users or []
+
+  def read_memberships(cursor, size):
+    """Reads the keys of members with a membership, skipping legacy ones."""
+    query = models.GroupMembership.all(keys_only=True).filter(
+        'group =', group.key())
+    keys, next_cursor = _read_query_page(query, cursor, size)
+    user_keys = [db.Key.from_path('UserProfile',
+                                  models.GroupMembership.user_id_of(key))
+                 for key in keys]
+    if legacy_keys:
+      legacy = set(legacy_keys)
+      user_keys = [key for key in user_keys if key not in legacy]
+    return user_keys, next_cursor
+
+  def read_legacy(offset, size):
+    """Reads the keys of legacy members, then of the first memberships."""
+    user_keys = legacy_keys[offset:offset + size]
+    if offset + size < len(legacy_keys):
+      return user_keys, '%s%d' % (LEGACY_CURSOR_PREFIX, offset + size)
+    if len(user_keys) == size:
+      has_more = models.GroupMembership.all(keys_only=True).filter(
+          'group =', group.key()).get()
+      return user_keys, has_more and '%s%d' % (LEGACY_CURSOR_PREFIX,
+                                               len(legacy_keys))
+    member_keys, next_cursor = read_memberships(None, size - len(user_keys))
+    return user_keys + member_keys, next_cursor
+
+  def read_page(cursor, size):
+    """Reads the members from the datastore."""
+    if cursor and cursor.startswith(LEGACY_CURSOR_PREFIX):
+      user_keys, next_cursor = read_legacy(
+          int(cursor[len(LEGACY_CURSOR_PREFIX):]), size)
+    elif not cursor and legacy_keys:
+      user_keys, next_cursor = read_legacy(0, size)
+    else:
+      user_keys, next_cursor = read_memberships(cursor, size)
+    profiles = db.get(user_keys)
+    emails = sorted(profile.email for profile in profiles if profile)
+    return [{'email': email} for email in emails], next_cursor
+
+  return _cached_page('members:%d' % group.key().id(), cursor, size,
+                      read_page)
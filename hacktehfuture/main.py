@@ -27,8 +27,10 @@ directly -- everything else is controlled from there.
 import os
 import sys
 import logging
+import time
 
 # Log a message each time this module get loaded.
+_LOAD_START = time.time()
 logging.info('Loading %s, app version = %s',
              __name__, os.getenv('CURRENT_VERSION_ID'))
 
@@ -40,14 +42,11 @@ from google.appengine.ext.webapp import util
 # Import webapp.template.  This makes most Django setup issues go away.
 from google.appengine.ext.webapp import template  # pylint: disable-msg=W0611
 
-# Import various parts of Django.
+# Import the parts of Django every request needs.  Forms are only used by the
+# admin views and are imported by forms.py on demand.
 import django.core.handlers.wsgi
 import django.core.signals
 import django.db
-import django.forms
-
-# Work-around to avoid warning about django.newforms in djangoforms.
-django.newforms = django.forms
 
 
 def log_exception(*args, **kwds):
@@ -64,10 +63,17 @@ django.core.signals.got_request_exception.connect(log_exception)
 django.core.signals.got_request_exception.disconnect(
     django.db._rollback_on_exception)  # pylint: disable-msg=W0212
 
+# The handler loads the middleware on its first request, so it is created once
+# per instance and kept alive together with this module.
+_application = django.core.handlers.wsgi.WSGIHandler()
+
+logging.info('Loaded %s in %.0f ms', __name__,
+             (time.time() - _LOAD_START) * 1000)
+
+
 def main():
   """Loads the django application."""
-  application = django.core.handlers.wsgi.WSGIHandler()
-  util.run_wsgi_app(application)
+  util.run_wsgi_app(_application)
 
 if __name__ == '__main__':
   main()
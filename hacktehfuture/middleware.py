@@ -17,15 +17,65 @@
 
 """Middleware classes for Django."""
 
+import hashlib
 import logging
 
 from django import http
+from django.utils import cache
 from google.appengine.api import users
+from google.appengine.ext import db
 
+import cachebackend
+import compression
 import models
+import ratelimit
+import unitofwork
 import utility
 
 
+class RateLimitMiddleware(object):
+  """Refuses requests from clients calling expensive URLs too often.
+
+  See ratelimit for the rules.  Listed before the middleware that loads the
+  user's profile, so a refused request does no datastore or template work.
+
+  """
+
+  def process_request(self, request):
+    # pylint: disable-msg=R0201
+    """Method defined by Django to handle processing requests.
+
+    Args:
+      request: the http request to process
+
+    Returns:
+      A 429 response if the client is over its limit, otherwise None
+    """
+    retry_after = ratelimit.check_request(request)
+    if retry_after is None:
+      return None
+    response = http.HttpResponse('Too many requests, please retry later.\n',
+                                 mimetype='text/plain')
+    response.status_code = 429
+    response['Retry-After'] = str(retry_after)
+    return response
+
+  def process_response(self, request, response):
+    # pylint: disable-msg=R0201
+    """Method defined by Django to handle processing responses.
+
+    Args:
+      request: the http request being answered
+      response: the http response to send
+
+    Returns:
+      The response
+    """
+    if response.status_code != 429:
+      ratelimit.check_response(request, response)
+    return response
+
+
 class AddUserToRequestMiddleware(object):
   # pylint: disable-msg=R0903
   """Adds a user data to each request.
@@ -46,6 +96,7 @@ class AddUserToRequestMiddleware(object):
     Returns:
       None
     """
+    utility.start_request()
     user = users.GetCurrentUser()
     request.user = user
     request.profile = None
@@ -62,3 +113,120 @@ class AddUserToRequestMiddleware(object):
       request.profile = profile
 
     return None
+
+
+class UnitOfWorkMiddleware(object):
+  """Writes the changes made by each view with one batch at the end.
+
+  See unitofwork for how models take part.  Listed last, so that the other
+  middleware sees the response only once the changes are written.
+
+  """
+
+  def process_request(self, request):
+    # pylint: disable-msg=R0201,W0613
+    """Method defined by Django to handle processing requests.
+
+    Args:
+      request: the http request to process
+
+    Returns:
+      None
+    """
+    unitofwork.begin()
+    return None
+
+  def process_response(self, request, response):
+    # pylint: disable-msg=R0201,W0613
+    """Method defined by Django to handle processing responses.
+
+    Args:
+      request: the http request being answered
+      response: the http response returned by the view
+
+    Returns:
+      The response once the changes made by the view are written, or an
+      error page in its place if they could not be
+    """
+    try:
+      unitofwork.commit()
+    except db.Error, err:
+      # The response usually reports success, so it must not be sent.
+      logging.exception('Could not write the changes: %s', err)
+      response = utility.respond(
+          request, '500',
+          {'error_message': 'Your changes could not be saved.  '
+                            'Please try again.'})
+      response.status_code = 500
+    return response
+
+  def process_exception(self, request, exception):
+    # pylint: disable-msg=R0201,W0613
+    """Method defined by Django to handle exceptions raised by views.
+
+    Args:
+      request: the http request being answered
+      exception: the exception raised by the view
+
+    Returns:
+      None, leaving the exception to be handled as usual
+    """
+    unitofwork.rollback()
+    return None
+
+
+class GZipMiddleware(object):
+  # pylint: disable-msg=R0903
+  """Compresses responses for clients that accept gzip.
+
+  Only responses of compressible types and at least
+  compression.MIN_RESPONSE_SIZE bytes long are compressed.  For responses
+  marked by utility.cache_compressed, the compressed body is cached under a
+  hash of the original body, so a repeated body is only compressed once.
+
+  """
+
+  def process_response(self, request, response):
+    # pylint: disable-msg=R0201
+    """Method defined by Django to handle processing responses.
+
+    Args:
+      request: the http request being answered
+      response: the http response to compress
+
+    Returns:
+      The response, compressed if appropriate
+    """
+    if response.status_code in (204, 206, 304) or response.has_header(
+        'Content-Encoding'):
+      return response
+    if not compression.is_compressible_type(response.get('Content-Type')):
+      return response
+
+    # The body differs by Accept-Encoding even when this one is not compressed.
+    cache.patch_vary_headers(response, ('Accept-Encoding',))
+    if not compression.accepts_gzip(request):
+      return response
+
+    content = response.content
+    if len(content) < compression.MIN_RESPONSE_SIZE:
+      return response
+
+    if getattr(response, 'cache_compressed', False):
+      # Stored directly: the bytes are already compressed, so going through
+      # utility.memcache_set would only compress them again.
+      key = 'gzip:%s' % hashlib.md5(content).hexdigest()
+      compressed = cachebackend.current().get(key)
+      if compressed is None:
+        compressed = compression.compress(content)
+        cachebackend.current().set(key, compressed)
+    else:
+      compressed = compression.compress(content)
+
+    if len(compressed) >= len(content):
+      return response
+    response.content = compressed
+    response['Content-Encoding'] = compression.GZIP
+    if response.has_header('Content-Length'):
+      response['Content-Length'] = str(len(compressed))
+    return response
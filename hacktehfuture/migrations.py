@@ -0,0 +1,211 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Resumable batch migrations for backfilling stored fields.
+
+A migration walks every entity of one kind in batches, ordered by key, and
+applies a transform to each.  The transform changes the entity in place and
+returns True if it needs saving; those entities are written with one db.put
+per batch, or handed to the migration's save function when writing them
+takes more than that.  Transforms have to be idempotent, since a batch may
+run again.
+
+After each batch the cursor and counts are checkpointed in a
+MigrationStatus, and the next batch runs in a new task, so a migration
+survives request deadlines and resumes where the last completed batch
+stopped.  A dry run goes through the same steps without writing the
+entities, to count how many would change.
+
+Each run has an id, passed along with every batch task.  Starting a
+migration again gives it a new id, so the batches still queued for the
+previous run find they are stale and stop instead of running alongside it.
+
+The entities are written directly, bypassing the put() overrides, so a
+backfill does not add to the change journal or invalidate the cache.
+
+"""
+
+import datetime
+import logging
+import uuid
+
+from django.core import urlresolvers
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+
+# Entities read per batch unless a migration asks for another size.
+DEFAULT_BATCH_SIZE = 100
+
+# Registered migrations by name.
+_MIGRATIONS = {}
+
+
+class Migration(object):
+  # pylint: disable-msg=R0903
+  """A registered transform over every entity of a kind."""
+
+  def __init__(self, name, kind, transform, description, batch_size, save):
+    # pylint: disable-msg=R0913
+    self.name = name
+    self.kind = kind
+    self.transform = transform
+    self.description = description
+    self.batch_size = batch_size
+    self.save = save or db.put
+
+
+class MigrationStatus(db.Model):
+  # pylint: disable-msg=R0904
+  """Progress of the latest run of a migration, keyed by its name."""
+
+  run_id = db.StringProperty(indexed=False)
+  cursor = db.TextProperty()
+  processed = db.IntegerProperty(default=0)
+  changed = db.IntegerProperty(default=0)
+  dry_run = db.BooleanProperty(default=False)
+  done = db.BooleanProperty(default=False)
+  error = db.TextProperty()
+  started = db.DateTimeProperty()
+  updated = db.DateTimeProperty(auto_now=True)
+
+
+def register(name, kind, transform, description='',
+             batch_size=DEFAULT_BATCH_SIZE, save=None):
+  """Makes a migration available to run.
+
+  Args:
+    name: unique name of the migration
+    kind: name of the model class to walk
+    transform: function changing an entity in place, returning True if it
+        has to be saved
+    description: what the migration does, shown in admin
+    batch_size: number of entities per batch
+    save: function writing a list of changed entities, for migrations that
+        have to do more than db.put them; not called on dry runs
+
+  """
+  # pylint: disable-msg=R0913
+  _MIGRATIONS[name] = Migration(name, kind, transform, description,
+                                batch_size, save)
+
+
+def all_migrations():
+  """Returns every registered migration with its status.
+
+  Returns:
+    A list of (Migration, MigrationStatus or None) tuples, ordered by name
+
+  """
+  names = sorted(_MIGRATIONS)
+  statuses = MigrationStatus.get_by_key_name(names) if names else []
+  return [(_MIGRATIONS[name], status) for name, status in zip(names, statuses)]
+
+
+def start(name, dry_run=False):
+  """Starts a migration from the beginning in the background.
+
+  A run of the migration still in progress is abandoned: its remaining
+  batches stop when they see the new run id.
+
+  Args:
+    name: name of a registered migration
+    dry_run: True to count the entities that would change without saving
+
+  Raises:
+    KeyError: No migration has the name
+
+  """
+  if name not in _MIGRATIONS:
+    raise KeyError(name)
+  run_id = uuid.uuid4().hex
+  MigrationStatus(key_name=name, run_id=run_id, dry_run=dry_run,
+                  started=datetime.datetime.utcnow()).put()
+  _queue(name, run_id)
+
+
+def _queue(name, run_id):
+  """Queues the next batch of a run of a migration."""
+  taskqueue.add(url=urlresolvers.reverse('views.tasks.run_migration'),
+                params={'name': name, 'run_id': run_id})
+
+
+def _checkpoint(status):
+  """Saves the progress of a run unless the migration was restarted.
+
+  Returns:
+    True if the progress was saved, False if another run has started
+
+  """
+
+  def txn():
+    """Writes the status if it still belongs to the same run."""
+    current = MigrationStatus.get(status.key())
+    if current is None or current.run_id != status.run_id:
+      return False
+    status.put()
+    return True
+
+  return db.run_in_transaction(txn)
+
+
+def run_batch(name, run_id):
+  """Migrates the next batch and checkpoints the progress.
+
+  The next batch is queued unless the migration has finished.  If the
+  transform raises, the error is recorded and the migration stops.
+
+  Args:
+    name: name of a registered migration that has been started
+    run_id: the id of the run the batch belongs to
+
+  Returns:
+    The MigrationStatus after the batch, or None if the run is not the
+    latest one
+
+  """
+  migration = _MIGRATIONS[name]
+  status = MigrationStatus.get_by_key_name(name)
+  if status is None or status.run_id != run_id:
+    return None
+  if status.done:
+    return status
+
+  query = db.class_for_kind(migration.kind).all()
+  if status.cursor:
+    query.with_cursor(status.cursor)
+  entities = query.fetch(migration.batch_size)
+  try:
+    changed = [entity for entity in entities if migration.transform(entity)]
+  except Exception, err:  # pylint: disable-msg=W0703
+    logging.exception('Migration %s failed', name)
+    status.error = '%s: %s' % (err.__class__.__name__, err)
+    status.done = True
+    _checkpoint(status)
+    return status
+
+  if changed and not status.dry_run:
+    migration.save(changed)
+  status.processed += len(entities)
+  status.changed += len(changed)
+  status.cursor = query.cursor()
+  status.done = len(entities) < migration.batch_size
+  if not _checkpoint(status):
+    return None
+  if not status.done:
+    _queue(name, run_id)
+  return status
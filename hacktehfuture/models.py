@@ -17,11 +17,22 @@
 
 """Datastore models."""
 
+import hashlib
+
 from django.core import urlresolvers
 from django.core import validators
 from django.utils import encoding
+from django.utils import simplejson
 from google.appengine.ext import db
 
+import autocomplete
+import cachepolicy
+import changes
+import compression
+import derivatives
+import search
+import snapshot
+import unitofwork
 import utility
 import yaml
 
@@ -53,9 +64,18 @@ class AccessControlList(db.Model):
     return new_acl
 
   def put(self):
-    """Saves the ACL and flushes the memcache."""
-    super(AccessControlList, self).put()
-    utility.clear_memcache()
+    """Saves the ACL and records the change in the unit of work.
+
+    A new ACL is written at once, since pages refer to it by its key.
+
+    """
+    if self.is_saved():
+      unitofwork.put([self, changes.new_record(self, changes.PUT)])
+    else:
+      super(AccessControlList, self).put()
+      unitofwork.put([changes.new_record(self, changes.PUT)])
+    cachepolicy.purge_entity(self)
+    return self.key()
 
   def __has_access(self, user, access_type):
     """Determines if user has the specified access type.
@@ -87,11 +107,8 @@ class AccessControlList(db.Model):
     if user is not None:
       if user.is_superuser or user.key() in user_list:
         has_access = True
-      else:
-        for group in UserGroup.get(group_list):
-          if user.key() in group.users:
-            has_access = True
-            break
+      elif user.group_keys.intersection(group_list):
+        has_access = True
 
     if has_access is None:
       has_access = False
@@ -130,21 +147,49 @@ class AccessControlList(db.Model):
 class File(db.Model):
   # pylint: disable-msg=R0904
   """Defines common properties and methods for pages and files."""
+
+  # References kept with the file when it is cached; see serialization.
+  CACHED_REFERENCES = ('parent_page', 'acl_data')
+
   name = db.StringProperty(required=True)
   created = db.DateTimeProperty(auto_now_add=True)
   modified = db.DateTimeProperty(auto_now=True)
   parent_page = db.SelfReferenceProperty()
   acl_data = db.ReferenceProperty(AccessControlList)
 
-  def put(self):
-    """Overridden method to flush the memcache."""
+  def put(self, invalidate=True):
+    """Overridden method to record the change in the unit of work.
+
+    The file, its ACL and the journal entry are written together with the
+    rest of the request's changes.  A new file is written at once, since it
+    only gets its key then.
+
+    Args:
+      invalidate: False if the change cannot affect any cached data, such as
+        new contents for an existing attachment
+
+    Returns:
+      The key of the file
+
+    """
+    entities = []
     if self.acl_data:
-      self.acl_data.put()
-    super(File, self).put()
-    utility.clear_memcache()
+      # Saved directly so that the journal only shows real ACL edits.
+      entities.append(self.acl_data)
+    if self.is_saved():
+      entities.append(self)
+    else:
+      db.put(entities + [self])
+      entities = []
+    entities.append(changes.new_record(self, changes.PUT))
+    unitofwork.put(entities, invalidate)
+    cachepolicy.purge_entity(self)
+    return self.key()
 
   def delete(self):
     """Overridden method to clean up ACLs and to flush the memcache."""
+    changes.record(self, changes.DELETE)
+    cachepolicy.purge_entity(self)
     if self.acl_data:
       self.acl_data.delete()
     super(File, self).delete()
@@ -223,6 +268,21 @@ class File(db.Model):
     """
     return self.acl.user_can_read(user)
 
+  def resolve_references(self):
+    """Fetches the parent page and the ACL together.
+
+    Called before a file is cached, so that they are cached along with it and
+    reading them after a cache hit costs no datastore get.
+
+    """
+    props = [File.properties()[name] for name in File.CACHED_REFERENCES]
+    props = [prop for prop in props
+             if prop.get_value_for_datastore(self) is not None]
+    entities = db.get([prop.get_value_for_datastore(self) for prop in props])
+    for prop, entity in zip(props, entities):
+      if entity is not None:
+        setattr(self, prop.name, entity)
+
   @property
   def path(self):
     """Returns the URL path used to access the page."""
@@ -233,15 +293,95 @@ class File(db.Model):
   @property
   def is_root(self):
     """Returns True for the root page, False for all others."""
-    return self.parent_page is None
+    return File.parent_page.get_value_for_datastore(self) is None
+
+
+class PageContent(db.Model):
+  """A class that holds the HTML content for a Page object.
+
+  The content is stored gzip-compressed in compressed_data, with encoding set
+  to compression.GZIP, unless compressing would not make it smaller; it is
+  then stored as is in data.
+
+  """
+
+  data = db.TextProperty()
+  compressed_data = db.BlobProperty()
+  encoding = db.StringProperty(indexed=False)
+  modified = db.DateTimeProperty(auto_now=True)
+
+  def __get_text(self):
+    """Returns the content, decompressing it if necessary."""
+    if self.encoding == compression.GZIP:
+      return compression.decompress(self.compressed_data).decode('utf-8')
+    return self.data
+
+  def __set_text(self, text):
+    """Stores the content, compressed if that makes it smaller."""
+    stored, content_encoding = compression.maybe_compress(
+        encoding.smart_str(text))
+    if content_encoding:
+      self.data = None
+      self.compressed_data = db.Blob(stored)
+    else:
+      self.data = text
+      self.compressed_data = None
+    self.encoding = content_encoding
+
+  text = property(__get_text, __set_text)
 
 
 class Page(File):
   # pylint: disable-msg=R0904
-  """Defines a page object which may have HTML content and associated files."""
+  """Defines a page object which may have HTML content and associated files.
+
+  This class contains a property content which abstracts the underlying child
+  PageContent object.  Pages are fetched for navigation far more often than
+  they are displayed, so the content is only read from the datastore when it
+  is actually referenced.
+
+  """
 
   title = db.StringProperty()
-  content = db.TextProperty()
+  content_data = db.ReferenceProperty(PageContent)
+  # Content of pages saved before it moved to PageContent, until the
+  # page-content migration in backfills moves it.
+  legacy_content = db.TextProperty(name='content')
+
+  def __get_content(self):
+    """Retrieves the content from the child object."""
+    content = getattr(self, '_pending_content', None)
+    if content is not None:
+      return content
+    if Page.content_data.get_value_for_datastore(self) is None:
+      return self.legacy_content
+    return self.content_data.text
+
+  def __set_content(self, content):
+    """Sets the content, which is written to the child object on put()."""
+    self._pending_content = content or u''
+
+  content = property(__get_content, __set_content)
+
+  def put(self):
+    """Overridden to save changed content before the page itself."""
+    content = getattr(self, '_pending_content', None)
+    if content is not None:
+      content_key = Page.content_data.get_value_for_datastore(self)
+      page_content = PageContent(key=content_key)
+      page_content.text = content
+      if content_key:
+        unitofwork.put([page_content], invalidate=False)
+      else:
+        # The page can only refer to the content once it has a key.
+        page_content.put()
+      self.content_data = page_content
+      self.legacy_content = None
+      self._pending_content = None
+    key = super(Page, self).put()
+    if content is not None:
+      search.queue_update(key.id())
+    return key
 
   def delete(self):
     """Overridden to ensure child objects are cleaned up on delete."""
@@ -249,6 +389,10 @@ class Page(File):
       page.delete()
     for file_store in self.filestore_children:
       file_store.delete()
+    content_key = Page.content_data.get_value_for_datastore(self)
+    if content_key:
+      db.delete(content_key)
+    search.queue_update(self.key().id())
     super(Page, self).delete()
 
   def get_child(self, name):
@@ -281,21 +425,8 @@ class Page(File):
   
   @property
   def breadcrumbs(self):
-    """Returns the HTML representation of the breadcrumbs for the page."""
-    key = 'breadcrumbs:%s' % self.key().id()
-    breadcrumbs = utility.memcache_get(key)
-    
-    if breadcrumbs:
-      return breadcrumbs
-    
-    breadcrumbs = []
-    if self.parent_page:
-      breadcrumbs = self.parent_page.breadcrumbs
-      breadcrumbs.append({'path': '/' + self.parent_page.path,
-                          'name': self.parent_page.name})
-      
-    utility.memcache_set(key, breadcrumbs)
-    return breadcrumbs 
+    """Returns the path and name of each ancestor of the page, root first."""
+    return snapshot.current().breadcrumbs(self.key().id())
 
   def get_attachment(self, name):
     """Retrieves a file with the given name that is attached to the page.
@@ -325,12 +456,147 @@ class Page(File):
     return file_list
 
 
+class FileStoreChunk(db.Model):
+  """One piece of the data of a file too large for a single entity."""
+
+  data = db.BlobProperty()
+
+
 class FileStoreData(db.Model):
-  """A class that holds the data for a FileStore object."""
+  """A class that holds the data for a FileStore object.
+
+  The key name is DIGEST_PREFIX followed by the SHA-1 of the data, so files
+  with the same contents share one FileStoreData; ref_count is the number of
+  FileStore objects using it.  Data saved before content addressing has a
+  numeric id and is not shared, until the file-data-keys migration in
+  backfills moves it.
+
+  Data of compressible types is stored gzip-compressed, with encoding set to
+  compression.GZIP.  Data too large for one entity is stored uncompressed in
+  the FileStoreChunk entities listed in chunks.
+
+  """
+
+  DIGEST_PREFIX = 'sha1:'
 
   data = db.BlobProperty()
+  chunks = db.ListProperty(db.Key, indexed=False)
+  encoding = db.StringProperty(indexed=False)
+  ref_count = db.IntegerProperty(default=1, indexed=False)
   modified = db.DateTimeProperty(auto_now=True)
 
+  def read(self):
+    """Returns the stored bytes, joining the chunks in one batched get."""
+    if self.chunks:
+      return ''.join(chunk.data for chunk in db.get(self.chunks))
+    return self.data
+
+  @classmethod
+  def key_for(cls, digest):
+    """Returns the key of the data with the given SHA-1 hex digest."""
+    return db.Key.from_path(cls.kind(), cls.DIGEST_PREFIX + digest)
+
+  @staticmethod
+  def digest_of(key):
+    """Returns the SHA-1 hex digest a key refers to, or None for old data."""
+    key_name = key.name()
+    if key_name and key_name.startswith(FileStoreData.DIGEST_PREFIX):
+      return key_name[len(FileStoreData.DIGEST_PREFIX):]
+    return None
+
+  @classmethod
+  def _acquire(cls, key, make):
+    """Takes a reference to the data with the given key.
+
+    Args:
+      key: the key of the FileStoreData
+      make: a function returning a new FileStoreData with that key, called if
+        the data is not stored yet
+
+    Returns:
+      True if the data was created, False if it was already stored
+
+    """
+
+    def txn():
+      """Increments the reference count, creating the data if needed."""
+      file_store_data = cls.get(key)
+      created = file_store_data is None
+      if created:
+        file_store_data = make()
+        file_store_data.ref_count = 0
+      file_store_data.ref_count += 1
+      file_store_data.put()
+      return created
+
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def acquire(cls, data, compressible):
+    """Returns the key of the stored copy of data, storing it if needed.
+
+    Args:
+      data: the file contents
+      compressible: True if the contents are of a type worth compressing
+
+    Returns:
+      The key of the FileStoreData, whose ref_count now includes the caller
+
+    """
+    key = cls.key_for(hashlib.sha1(data).hexdigest())
+
+    def make():
+      """Stores the data, compressed if that makes it smaller."""
+      stored, content_encoding = data, None
+      if compressible:
+        stored, content_encoding = compression.maybe_compress(data)
+      return cls(key=key, data=db.Blob(stored), encoding=content_encoding)
+
+    cls._acquire(key, make)
+    return key
+
+  @classmethod
+  def acquire_chunks(cls, digest, chunk_keys):
+    """Returns the key of data already saved as FileStoreChunk entities.
+
+    If the same data is already stored, the chunks are deleted and the
+    existing copy is used.
+
+    Args:
+      digest: the SHA-1 hex digest of the data
+      chunk_keys: the keys of the chunks, in order
+
+    Returns:
+      The key of the FileStoreData, whose ref_count now includes the caller
+
+    """
+    key = cls.key_for(digest)
+    if not cls._acquire(key, lambda: cls(key=key, chunks=chunk_keys)):
+      db.delete(chunk_keys)
+    return key
+
+  @classmethod
+  def release(cls, key):
+    """Drops a reference to stored data, deleting it with the last one."""
+
+    def txn():
+      """Decrements the reference count, returning the data if it is gone."""
+      file_store_data = cls.get(key)
+      if file_store_data is None:
+        return None
+      file_store_data.ref_count -= 1
+      if file_store_data.ref_count > 0:
+        file_store_data.put()
+        return None
+      file_store_data.delete()
+      return file_store_data
+
+    deleted = db.run_in_transaction(txn)
+    if deleted is not None:
+      if deleted.chunks:
+        db.delete(deleted.chunks)
+      derivatives.delete_variants(key)
+
 
 class FileStore(File):
   # pylint: disable-msg=R0904
@@ -339,7 +605,8 @@ class FileStore(File):
   This class contains a property data which abstracts the underlying child
   FileStoreData object.  The data property should be treated as though
   it were a BlobProperty.  This prevents the Blob being read into memory
-  until it is actually referenced.
+  until it is actually referenced.  Like other properties, changes to it are
+  saved by put().
 
   """
 
@@ -348,29 +615,80 @@ class FileStore(File):
   blob_data = db.ReferenceProperty(FileStoreData)
 
   def __get_data(self):
-    """Retrieves the data from the child object."""
-    return self.blob_data.data
+    """Retrieves the data from the child object, decompressing it."""
+    data, content_encoding = self.encoded_data()
+    if content_encoding == compression.GZIP:
+      return compression.decompress(data)
+    return data
 
   def __set_data(self, data):
-    """Sets the data on the child object, creating one if necessary."""
+    """Points the file at the shared copy of data, storing it if needed.
+
+    Setting data that is already stored, including the file's current data,
+    does not write any FileStoreData.
+
+    """
     if not data:
-      if self.blob_data:
-        self.blob_data.delete()
-        self.blob_data = None
-        self.put()
+      self.set_data_key(None)
+    elif self.digest != hashlib.sha1(data).hexdigest():
+      self.set_data_key(FileStoreData.acquire(
+          data, compression.is_compressible_name(self.name)))
+
+  data = property(__get_data, __set_data)
+
+  def set_data_key(self, key):
+    """Points the file at a FileStoreData the caller holds a reference to.
+
+    The reference to the previously saved data is dropped once the file is
+    saved; data set since then but never saved is released straight away.
+
+    Args:
+      key: the key of the FileStoreData, or None to remove the data
+
+    """
+    old_key = self.data_key
+    if key == old_key:
+      if key:
+        FileStoreData.release(key)
       return
+    if not hasattr(self, '_released_key'):
+      self._released_key = old_key
+    elif old_key:
+      FileStoreData.release(old_key)
+    self.blob_data = key
+    if key:
+      self.url_data = None
 
-    if not self.blob_data:
-      file_store_data = FileStoreData()
-      file_store_data.put()
-      self.blob_data = file_store_data
-      self.put()
-    self.blob_data.data = data
-    self.blob_data.put()
-    self.url = None
-    self.put()
+  def put(self, invalidate=True):
+    """Overridden to release replaced data once the file no longer uses it."""
+    key = super(FileStore, self).put(invalidate)
+    released_key = getattr(self, '_released_key', None)
+    if hasattr(self, '_released_key'):
+      del self._released_key
+    if released_key:
+      unitofwork.after_commit(FileStoreData.release, released_key)
+    return key
 
-  data = property(__get_data, __set_data)
+  def encoded_data(self):
+    """Returns the data as stored, without decompressing it.
+
+    Returns:
+      A tuple of the stored bytes and their encoding, compression.GZIP or None
+
+    """
+    file_store_data = self.blob_data
+    return file_store_data.read(), file_store_data.encoding
+
+  @property
+  def data_key(self):
+    """Returns the key of the FileStoreData without fetching it."""
+    return FileStore.blob_data.get_value_for_datastore(self)
+
+  @property
+  def digest(self):
+    """Returns the SHA-1 hex digest of the data, or None if it is unknown."""
+    key = self.data_key
+    return key and FileStoreData.digest_of(key)
 
   def __get_url(self):
     """Exposes the url property."""
@@ -388,9 +706,11 @@ class FileStore(File):
 
   def delete(self):
     """Overridden to ensure child objects are cleaned up on delete."""
-    if self.blob_data:
-      self.blob_data.delete()
+    data_key = self.data_key
     super(FileStore, self).delete()
+    for key in (data_key, getattr(self, '_released_key', None)):
+      if key:
+        FileStoreData.release(key)
 
 
 class UserProfile(db.Model):
@@ -399,6 +719,8 @@ class UserProfile(db.Model):
 
   email = db.EmailProperty(required=True)
   is_superuser = db.BooleanProperty(default=False)
+  # Lowercased email, for prefix lookup by autocomplete.
+  email_lower = db.StringProperty()
 
   def __str__(self):
     """Overridden string representation."""
@@ -422,10 +744,19 @@ class UserProfile(db.Model):
       utility.memcache_set(key, profile)
     return profile
 
+  def set_lowercase(self):
+    """Updates the lowercased copy of the email address."""
+    self.email_lower = autocomplete.normalize(self.email)
+
   def put(self):
-    """Saves the profile and flushes the memcache."""
-    super(UserProfile, self).put()
-    utility.clear_memcache()
+    """Saves the profile in the unit of work; a new one is written at once."""
+    self.set_lowercase()
+    if self.is_saved():
+      unitofwork.put([self])
+    else:
+      super(UserProfile, self).put()
+      unitofwork.invalidate()
+    return self.key()
 
   @property
   def groups(self):
@@ -435,12 +766,42 @@ class UserProfile(db.Model):
       The list of groups the user is in
 
     """
-    key = 'users_groups:%s' % self.key().id()
-    groups = utility.memcache_get(key)
-    if not groups:
-      groups = list(UserGroup.all().filter('users = ', self.key()))
-      utility.memcache_set(key, groups)
-    return groups
+    return [group for group in UserGroup.get(list(self.group_keys)) if group]
+
+  @property
+  def group_ids(self):
+    """Returns the ids of all of the groups the user is in.
+
+    The ids are read from the key names of the user's memberships, so no
+    group is fetched, and cached until the next change.
+
+    Returns:
+      A frozenset of UserGroup ids
+
+    """
+    key = 'group-ids:%s' % self.key().id()
+    group_ids = utility.memcache_get(key)
+    if group_ids is None:
+      query = GroupMembership.all(keys_only=True).filter('user =', self.key())
+      group_ids = [GroupMembership.group_id_of(membership)
+                   for membership in query]
+      # Groups whose members have not been moved out of UserGroup.users yet.
+      query = UserGroup.all(keys_only=True).filter('users =', self.key())
+      group_ids.extend(group_key.id() for group_key in query)
+      group_ids = sorted(set(group_ids))
+      utility.memcache_set(key, group_ids)
+    return frozenset(group_ids)
+
+  @property
+  def group_keys(self):
+    """Returns the keys of all of the groups the user is in.
+
+    Returns:
+      A frozenset of UserGroup keys
+
+    """
+    return frozenset(db.Key.from_path('UserGroup', group_id)
+                     for group_id in self.group_ids)
 
   @property
   def groups_not_in(self):
@@ -450,13 +811,14 @@ class UserProfile(db.Model):
       The list of groups the user is not in
 
     """
-    all_group_keys = [g.key().id() for g in UserGroup.all_groups()]
-    self_group_keys = [g.key().id() for g in self.groups]
-    not_in_group_keys = [k for k in all_group_keys if k not in self_group_keys]
-    return UserGroup.get_by_id(not_in_group_keys)
+    group_ids = self.group_ids
+    return [group for group in UserGroup.all_groups()
+            if group.key().id() not in group_ids]
 
   def delete(self):
-    """Overridden to ensure memcache is cleared."""
+    """Overridden to remove the user from groups and clear the memcache."""
+    GroupMembership.delete_all(
+        GroupMembership.all(keys_only=True).filter('user =', self.key()))
     super(UserProfile, self).delete()
     utility.clear_memcache()
 
@@ -469,11 +831,11 @@ class UserProfile(db.Model):
       is_superuser: boolean value denoting if the user should be an editor
 
     Returns:
-      True if the user is created/edited, False if the email address is invalid
+      The saved UserProfile, or None if the email address is invalid
 
     """
     if not validators.email_re.search(email):
-      return False
+      return None
 
     user = UserProfile.load(email)
     if user:
@@ -482,35 +844,111 @@ class UserProfile(db.Model):
       user = UserProfile(email=email, is_superuser=is_superuser)
 
     user.put()
-    return True
+    return user
 
 
 class UserGroup(db.Model):
   # pylint: disable-msg=R0904
-  """Model for logically grouping users for access control."""
+  """Model for logically grouping users for access control.
+
+  Members are recorded as GroupMembership entities.  users only holds members
+  added before those existed, until migrate_members moves them.
+
+  """
 
   name = db.StringProperty(required=True)
   description = db.StringProperty()
   users = db.ListProperty(db.Key)
+  # Lowercased name, for prefix lookup by autocomplete.
+  name_lower = db.StringProperty()
 
   def __str__(self):
     """Overridden string representation."""
     return encoding.smart_str(self.name)
 
+  def set_lowercase(self):
+    """Updates the lowercased copy of the name."""
+    self.name_lower = autocomplete.normalize(self.name)
+
   def put(self):
     """Overridden method to ensure name is kept unique."""
+    self.set_lowercase()
     for group in UserGroup.all().filter('name = ', self.name):
       if not self.is_saved() or group.key() != self.key():
         raise db.BadValueError('There is already a group named "%s"'
                                % self.name)
-    super(UserGroup, self).put()
-    utility.clear_memcache()
+    if self.is_saved():
+      unitofwork.put([self])
+    else:
+      super(UserGroup, self).put()
+      unitofwork.invalidate()
+    return self.key()
 
   def delete(self):
-    """Overridden to ensure memcache is cleared."""
+    """Overridden to delete the memberships and clear the memcache."""
+    GroupMembership.delete_all(
+        GroupMembership.all(keys_only=True).filter('group =', self.key()))
     super(UserGroup, self).delete()
     utility.clear_memcache()
 
+  def member_keys(self):
+    """Returns the keys of every member of the group.
+
+    Returns:
+      A list of UserProfile keys
+
+    """
+    query = GroupMembership.all(keys_only=True).filter('group =', self.key())
+    member_keys = set(self.users or [])
+    member_keys.update(db.Key.from_path('UserProfile',
+                                        GroupMembership.user_id_of(key))
+                       for key in query)
+    return list(member_keys)
+
+  def add_members(self, user_keys):
+    """Adds users to the group; users already in it are unaffected.
+
+    Each member is a blind write of its GroupMembership, so the cost does not
+    depend on the size of the group.  The memberships are written at once, in
+    batches of GroupMembership.BATCH_SIZE, rather than with the unit of work,
+    and the cache is invalidated once they are.
+
+    Args:
+      user_keys: keys of the UserProfiles to add
+
+    """
+    memberships = [GroupMembership.create(self.key(), user_key)
+                   for user_key in user_keys]
+    for i in range(0, len(memberships), GroupMembership.BATCH_SIZE):
+      db.put(memberships[i:i + GroupMembership.BATCH_SIZE])
+    unitofwork.invalidate()
+
+  def remove_members(self, user_keys):
+    """Removes users from the group; users not in it are ignored.
+
+    The memberships are deleted at once in batches, like add_members.
+
+    Args:
+      user_keys: keys of the UserProfiles to remove
+
+    """
+    if self.users:
+      self.migrate_members()
+    keys = [GroupMembership.key_for(self.key(), user_key)
+            for user_key in user_keys]
+    for i in range(0, len(keys), GroupMembership.BATCH_SIZE):
+      db.delete(keys[i:i + GroupMembership.BATCH_SIZE])
+    unitofwork.invalidate()
+
+  def migrate_members(self):
+    """Moves the members listed in users into GroupMembership entities."""
+    memberships = [GroupMembership.create(self.key(), user_key)
+                   for user_key in self.users or []]
+    for i in range(0, len(memberships), GroupMembership.BATCH_SIZE):
+      db.put(memberships[i:i + GroupMembership.BATCH_SIZE])
+    self.users = []
+    self.put()
+
   @staticmethod
   def all_groups():
     """Returns a list of all of the groups in the system.
@@ -527,42 +965,142 @@ class UserGroup(db.Model):
     return groups
 
 
+class GroupMembership(db.Model):
+  # pylint: disable-msg=R0904
+  """Records that a user is in a group.
+
+  The key name is '<group id>:<user id>', so adding a member is a blind write
+  and removing one a delete by key, however large the group is, and the
+  groups of a user can be read from the keys alone.
+
+  """
+
+  # Most memberships written or deleted with one datastore call.
+  BATCH_SIZE = 500
+
+  group = db.ReferenceProperty(UserGroup, required=True,
+                               collection_name='memberships')
+  user = db.ReferenceProperty(UserProfile, required=True,
+                              collection_name='memberships')
+
+  @staticmethod
+  def key_for(group_key, user_key):
+    """Returns the key of the membership of a user in a group."""
+    return db.Key.from_path('GroupMembership',
+                            '%d:%d' % (group_key.id(), user_key.id()))
+
+  @staticmethod
+  def create(group_key, user_key):
+    """Returns a new, unsaved membership of a user in a group."""
+    return GroupMembership(key=GroupMembership.key_for(group_key, user_key),
+                           group=group_key, user=user_key)
+
+  @staticmethod
+  def group_id_of(key):
+    """Returns the id of the group from the key of a membership."""
+    return int(key.name().split(':')[0])
+
+  @staticmethod
+  def user_id_of(key):
+    """Returns the id of the user from the key of a membership."""
+    return int(key.name().split(':')[1])
+
+  @staticmethod
+  def delete_all(query):
+    """Deletes every membership returned by a keys-only query."""
+    keys = query.fetch(GroupMembership.BATCH_SIZE)
+    while keys:
+      db.delete(keys)
+      query.with_cursor(query.cursor())
+      keys = query.fetch(GroupMembership.BATCH_SIZE)
+
+
 class Sidebar(db.Model):
   # pylint: disable-msg=R0904
-  """Model for the left-hand navigation."""
+  """Model for the left-hand navigation.
+
+  There is a single sidebar, stored under KEY_NAME.  The YAML written by
+  editors is compiled when the sidebar is saved into sections, a JSON list of
+  [heading, [[page id, title], ...]] pairs, and page_ids, every page id the
+  sidebar refers to, so nothing on the request path parses YAML.
+
+  """
+
+  KEY_NAME = 'sidebar'
 
   yaml = db.TextProperty(required=True)
+  sections = db.TextProperty()
+  page_ids = db.ListProperty(int, indexed=False)
   modified = db.DateTimeProperty(auto_now=True)
 
-  def __try_parse(self):
-    """Attempts to parse the provided YAML.
+  def compile(self):
+    """Parses the YAML into sections and page_ids.
 
     If the YAML is malformed or the expected keys are not present exceptions
     will be thrown.
 
     """
+    sections = []
     for section in yaml.load_all(self.yaml):
-      if section['heading']:
-        for item in section['pages']:
-          if item['id']:
-            if item['title']:
-              pass
+      items = [[int(item['id']), item['title']]
+               for item in section['pages'] or []]
+      sections.append([section['heading'], items])
+    self.set_sections(sections)
+
+  def set_sections(self, sections):
+    """Stores already compiled sections along with their page ids.
+
+    Args:
+      sections: a list of [heading, [[page id, title], ...]] pairs
+
+    """
+    self.sections = simplejson.dumps(sections)
+    self.page_ids = sorted(set(page_id for _, items in sections
+                               for page_id, _ in items))
+    self._compiled_yaml = self.yaml
+
+  def get_sections(self):
+    """Returns the compiled sections, as stored by set_sections."""
+    return simplejson.loads(self.sections or '[]')
 
   def put(self):
-    """Saves the sidebar and flushes the memcache."""
-    self.__try_parse()
-    super(Sidebar, self).put()
-    utility.clear_memcache()
+    """Compiles the sidebar if it changed and saves it in the unit of work."""
+    if getattr(self, '_compiled_yaml', None) != self.yaml:
+      self.compile()
+    cachepolicy.purge_entity(self)
+    if self.is_saved():
+      unitofwork.put([self])
+    else:
+      super(Sidebar, self).put()
+      unitofwork.invalidate()
+    return self.key()
+
+  @staticmethod
+  def create(yaml_data):
+    """Returns a new, unsaved sidebar under the singleton key."""
+    return Sidebar(key_name=Sidebar.KEY_NAME, yaml=yaml_data)
 
   @staticmethod
   def load():
     """Retrieves the sidebar from the datastore.
 
+    A sidebar saved before it had a key name or compiled sections is
+    converted the first time it is loaded.
+
     Returns:
-      SideBar object
+      SideBar object, or None if there is no sidebar yet
 
     """
-    return Sidebar.all().get()
+    sidebar = Sidebar.get_by_key_name(Sidebar.KEY_NAME)
+    if sidebar is None:
+      old_sidebar = Sidebar.all().get()
+      if old_sidebar is not None:
+        sidebar = Sidebar.create(old_sidebar.yaml)
+        sidebar.put()
+        old_sidebar.delete()
+    elif sidebar.sections is None:
+      sidebar.put()
+    return sidebar
 
   @staticmethod
   def contains_page(page):
@@ -572,45 +1110,36 @@ class Sidebar(db.Model):
       page: Page to check if it exists in the sidebar
 
     """
-    key = 'page-in-sidebar:%s' % page.key().id()
-    in_sidebar = utility.memcache_get(key)
-    if in_sidebar is not None:
-      return in_sidebar
-
-    sidebar = Sidebar.load()
-
-    if sidebar is not None:
-      for section in yaml.load_all(sidebar.yaml):
-        for item in section['pages']:
-          if item['id'] == page.key().id():
-            utility.memcache_set(key, True)
-            return True
-
-    utility.memcache_set(key, False)
-    return False
+    return page.key().id() in snapshot.current().sidebar_page_ids
 
   @staticmethod
   def add_page(page):
     """Appends a page to the bottom of the sidebar.
 
+    The compiled sections are extended and the YAML regenerated from them,
+    so the stored YAML is not parsed again.
+
     Args:
       page: Page to append
 
     """
     sidebar = Sidebar.load()
-
+    sections = [['', []]]
+    if sidebar is not None:
+      sections = sidebar.get_sections() or sections
+    sections[-1][1].append([page.key().id(), page.title])
+
+    # The YAML is built before a new sidebar is made, since it is required.
+    yaml_data = yaml.safe_dump_all(
+        [{'heading': heading,
+          'pages': [{'id': page_id, 'title': title}
+                    for page_id, title in items]}
+         for heading, items in sections])
     if sidebar is None:
-      sidebar = Sidebar(yaml="---\nheading: ''\n\n")
-
-    sidebar_documents = list(yaml.load_all(sidebar.yaml))
-    if sidebar_documents:
-      last_document = sidebar_documents[-1]
-      if not last_document.has_key('pages'):
-        last_document['pages'] = []
-      last_document['pages'].append({'id': page.key().id(),
-                                     'title': page.title})
-
-    sidebar.yaml = yaml.safe_dump_all(sidebar_documents)
+      sidebar = Sidebar.create(yaml_data)
+    else:
+      sidebar.yaml = yaml_data
+    sidebar.set_sections(sections)
     sidebar.put()
 
   @staticmethod
@@ -641,25 +1170,21 @@ class Sidebar(db.Model):
       return html
 
     html = []
-    sidebar = Sidebar.load()
-
-    if not sidebar:
-      return ''
+    site = snapshot.current()
+    can_read = site.reader(profile)
 
-    for section in yaml.load_all(sidebar.yaml):
+    for heading, items in site.sidebar:
       section_html = []
 
-      for item in section['pages']:
-        # pylint: disable-msg=E1103
-        page = Page.get_by_id(int(item['id']))
-        if not page or not page.user_can_read(profile):
+      for page_id, title in items:
+        page = site.page(page_id)
+        if not page or page.path is None or not can_read(page):
           continue
         url = urlresolvers.reverse('views.main.get_url', args=[page.path])
-        section_html.append('<li><a href="%s">%s</a></li>\n' %
-                            (url, item['title']))
+        section_html.append('<li><a href="%s">%s</a></li>\n' % (url, title))
 
       if section_html:
-        html.append('<h1>%s</h1>\n' % section['heading'])
+        html.append('<h1>%s</h1>\n' % heading)
         html.append('<ul>\n%s</ul>\n' % ''.join(section_html))
 
     html = ''.join(html)
@@ -0,0 +1,171 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Moving and renaming pages, and redirects from the paths they left.
+
+Paths, breadcrumbs and inherited ACLs are all derived from the parent links
+when the site snapshot is built, so moving a page only rewrites the page
+itself.  The old path of the page is recorded in a PathRedirect pointing at
+the page by id, which covers the whole subtree: a request for a path under
+the old location is redirected to the same path under the page's current
+location, wherever it has moved to since.
+
+The change journal gets an entry for every page and file in the subtree,
+since all of their URLs changed.  Those are written on the task queue in
+batches that continue where the previous one stopped.
+
+"""
+
+from django.core import urlresolvers
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import changes
+import snapshot
+import unitofwork
+import validators
+
+
+# Number of pages and files journaled per task.
+JOURNAL_BATCH_SIZE = 50
+
+
+class PathRedirect(db.Model):
+  # pylint: disable-msg=R0904
+  """Redirects a path a page used to have to that page.
+
+  The key name is the old path without leading or trailing slashes.
+
+  """
+
+  page_id = db.IntegerProperty(required=True, indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+class MoveError(Exception):
+  """Raised when a page cannot be moved to the requested place."""
+
+
+def move_page(page, parent, name):
+  """Moves a page and its subtree under a new parent and/or renames it.
+
+  Args:
+    page: the Page to move
+    parent: the Page to move it under
+    name: the new name of the page
+
+  Raises:
+    MoveError: The page cannot be moved there
+
+  """
+  if page.is_root:
+    raise MoveError('The root page cannot be moved.')
+  validators.is_valid_page_name(name)
+
+  site = snapshot.current()
+  record = site.page(parent.key().id())
+  while record is not None:
+    if record.id == page.key().id():
+      raise MoveError('A page cannot be moved beneath itself.')
+    record = record.parent
+
+  same_parent = parent.key() == page.parent_page.key()
+  if same_parent and name == page.name:
+    return
+  existing = parent.get_child(name) or parent.get_attachment(name)
+  if existing is not None and existing.key() != page.key():
+    raise MoveError('%s already has a page or file named %s.' %
+                    (parent.title, name))
+
+  old_path = page.path
+  page.parent_page = parent
+  page.name = name
+  page.put()
+  record_move(page, old_path)
+
+
+def record_move(page, old_path):
+  """Keeps the old path of a page working once it has moved.
+
+  Redirects that the new location now covers are deleted: the one at the new
+  path itself, which would otherwise send every unknown path beneath the
+  page back to it, and those beneath it that point into the moved subtree.
+
+  Args:
+    page: the Page after it was moved or renamed
+    old_path: the path the page had before, in File.path form
+
+  """
+  new_path = page.path
+  if old_path == new_path:
+    return
+  site = snapshot.current()
+  page_id = page.key().id()
+  subtree = set([page_id])
+  subtree.update(record.id for record in site.descendants(page_id)
+                 if record.kind == 'Page')
+  new_path = new_path.strip('/')
+  stale = [db.Key.from_path('PathRedirect', path)
+           for path, target_id in site.redirects_under(new_path)
+           if path == new_path or target_id in subtree]
+  if stale:
+    unitofwork.delete(stale)
+  unitofwork.put([PathRedirect(key_name=old_path.strip('/'),
+                               page_id=page.key().id())])
+  # The task reads the new paths, so it is queued once they are written.
+  unitofwork.after_commit(
+      taskqueue.add, url=urlresolvers.reverse('views.tasks.journal_move'),
+      params={'page_id': page.key().id()})
+
+
+def journal_subtree(page_id, offset=0):
+  """Journals a batch of the pages and files beneath a moved page.
+
+  Args:
+    page_id: id of the moved page
+    offset: how many pages and files earlier batches journaled
+
+  Returns:
+    The offset to continue from, or None once the whole subtree is done
+
+  """
+  records = snapshot.current().descendants(page_id)
+  batch = records[offset:offset + JOURNAL_BATCH_SIZE]
+  db.put([changes.ChangeRecord(kind=record.kind, entity_id=record.id,
+                               action=changes.PUT, name=record.name,
+                               path=record.path)
+          for record in batch])
+  offset += len(batch)
+  if offset >= len(records):
+    return None
+  return offset
+
+
+def redirect_target(path):
+  """Finds where a path that no longer exists has moved to.
+
+  The redirects are part of the site snapshot, so this makes no RPCs.
+
+  Args:
+    path: the requested path without leading or trailing slashes
+
+  Returns:
+    The URL to redirect to, or None if the path never belonged to a page
+
+  """
+  if not path:
+    return None
+  return snapshot.current().redirect_target(path)
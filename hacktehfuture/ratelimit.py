@@ -0,0 +1,164 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Rate limits on expensive URLs.
+
+Each rule in configuration.RATE_LIMITS lets every client make a number of
+requests per fixed window and refuses the rest until the next window starts.
+A request costs one memcache incr: the count of requests the client made
+this window is kept in the memcache under a key naming the window, so it
+starts again by itself.
+
+This is a fixed window rather than a token bucket on purpose.  A bucket has
+to store its tokens together with the time of its last refill and update
+both at once, which needs a compare-and-set this memcache API does not
+offer; incr is the only atomic update available.  The cost is that a client
+can make two windows' worth of requests in a burst spanning the boundary
+between them.
+
+Rules limited to some response statuses, such as 404, are checked with a
+single get before the request is handled, so a client over the limit is
+refused before any other work, and only count a request once its response
+has one of the statuses.
+
+"""
+
+import math
+import re
+import time
+
+from google.appengine.api import users
+import cachebackend
+import configuration
+
+
+_KEY_PREFIX = 'ratelimit:'
+
+
+class Rule(object):
+  # pylint: disable-msg=R0903
+  """A limit on the requests matching a path pattern."""
+
+  def __init__(self, index, pattern, scope, size, period, statuses):
+    # pylint: disable-msg=R0913
+    self.index = index
+    self.pattern = re.compile(pattern)
+    self.scope = scope
+    self.size = size
+    self.period = period
+    self.statuses = statuses and frozenset(statuses)
+
+  def _client(self, request):
+    """Returns what identifies the client for this rule."""
+    if self.scope == 'user':
+      user = users.get_current_user()
+      if user is not None:
+        return 'user:%s' % user.email()
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+  def _count_key(self, request, now):
+    """Returns the memcache key of the client's count for this period.
+
+    Returns:
+      A tuple of the key and the seconds until the period is over
+
+    """
+    period_number = int(now // self.period)
+    key = '%s%d:%s:%d' % (_KEY_PREFIX, self.index, self._client(request),
+                          period_number)
+    remaining = (period_number + 1) * self.period - now
+    return key, max(1, int(math.ceil(remaining)))
+
+  def take(self, request, now):
+    """Counts a request against the client's limit.
+
+    Returns:
+      None if the request is within the limit, otherwise the seconds to wait
+
+    """
+    key, retry_after = self._count_key(request, now)
+    cache = cachebackend.current()
+    taken = cache.incr(key)
+    if taken is None:
+      # The count is only needed until its period is over.
+      cache.add(key, 0, time=self.period + 1)
+      taken = cache.incr(key)
+    # Without the memcache, let requests through rather than refuse all.
+    if taken is None or taken <= self.size:
+      return None
+    return retry_after
+
+  def peek(self, request, now):
+    """Checks the client's count without counting the request.
+
+    Returns:
+      None if the client is within the limit, otherwise the seconds to wait
+
+    """
+    key, retry_after = self._count_key(request, now)
+    taken = cachebackend.current().get(key) or 0
+    if taken < self.size:
+      return None
+    return retry_after
+
+
+RULES = [Rule(index, *rule)  # pylint: disable-msg=W0142
+         for index, rule in enumerate(configuration.RATE_LIMITS)]
+
+
+def check_request(request):
+  """Checks a request against every rule before it is handled.
+
+  Rules that apply to every request count it; rules limited to response
+  statuses only check the count, which check_response adds to.
+
+  Args:
+    request: the Django request
+
+  Returns:
+    None if the request may go ahead, otherwise the seconds to wait
+
+  """
+  now = time.time()
+  for rule in RULES:
+    if not rule.pattern.match(request.path):
+      continue
+    if rule.statuses:
+      retry_after = rule.peek(request, now)
+    else:
+      retry_after = rule.take(request, now)
+    if retry_after is not None:
+      return retry_after
+  return None
+
+
+def check_response(request, response):
+  """Counts a request against the rules limited to the status of its response.
+
+  The response is sent either way; check_request refuses the client's next
+  request once it is over the limit.
+
+  Args:
+    request: the Django request
+    response: the response being sent
+
+  """
+  now = time.time()
+  for rule in RULES:
+    if (rule.statuses and response.status_code in rule.statuses and
+        rule.pattern.match(request.path)):
+      rule.take(request, now)
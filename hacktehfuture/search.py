@@ -0,0 +1,341 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Full-text search over page titles and content.
+
+Each page is tokenized when it is saved and its terms are added to an
+inverted index.  The posting list of a term is split over POSTING_SHARDS
+entities, chosen by page id, so that saving one page never rewrites the
+postings of every other page containing a common word.  A query fetches the
+shards of all of its terms in a single batched get.
+
+Saving or deleting a page only queues it; a task updates the index once the
+change is written, so the request never waits for the posting shards.
+
+"""
+
+import math
+import re
+
+from django.core import urlresolvers
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import models
+import snapshot
+import unitofwork
+import utility
+
+
+# Number of entities each term's posting list is split across.
+POSTING_SHARDS = 8
+
+# Each occurrence of a term in the title counts as this many in the content.
+TITLE_WEIGHT = 5
+
+# Number of pages indexed per request by reindex_batch.
+REINDEX_BATCH_SIZE = 20
+
+# Number of results shown per page of search results.
+RESULTS_PER_PAGE = 10
+
+# Words longer than this are not indexed.
+MAX_TERM_LENGTH = 40
+
+# Terms beyond this many in a query are ignored.
+MAX_QUERY_TERMS = 10
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'with'])
+
+# Entity operations are limited to this many entities per call.
+_BATCH_LIMIT = 500
+
+_MARKUP_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>|&#?\w+;',
+                        re.IGNORECASE | re.DOTALL)
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Ids of the pages saved or deleted since the last task was queued.
+_pending = set()
+
+
+class SearchPosting(db.Model):
+  # pylint: disable-msg=R0904
+  """One shard of the posting list of a term.
+
+  The key name is '<term>:<shard>'.  page_ids and weights are parallel lists
+  giving every page in the shard that contains the term and how often.
+
+  """
+
+  page_ids = db.ListProperty(int, indexed=False)
+  weights = db.ListProperty(int, indexed=False)
+
+
+class SearchDocument(db.Model):
+  # pylint: disable-msg=R0904
+  """Records the terms a page was last indexed under, keyed by page id."""
+
+  terms = db.StringListProperty(indexed=False)
+
+
+def tokenize(text):
+  """Splits text into lower case search terms, ignoring any HTML markup.
+
+  Args:
+    text: the text or HTML to tokenize
+
+  Returns:
+    A list of terms in the order they appear, including repetitions
+
+  """
+  if not text:
+    return []
+  words = _WORD_RE.findall(_MARKUP_RE.sub(' ', text).lower())
+  return [word for word in words
+          if 1 < len(word) <= MAX_TERM_LENGTH and word not in STOP_WORDS]
+
+
+def _posting_key(term, page_id):
+  """Returns the key of the posting shard holding term for page_id."""
+  return db.Key.from_path('SearchPosting',
+                          u'%s:%d' % (term, page_id % POSTING_SHARDS))
+
+
+def _batches(items):
+  """Splits a list into slices no larger than the datastore allows."""
+  return [items[i:i + _BATCH_LIMIT] for i in range(0, len(items), _BATCH_LIMIT)]
+
+
+def _set_weight(key, page_id, weight):
+  """Sets the weight of a page in one posting shard, in a transaction.
+
+  Shards are shared by many pages, so concurrent saves must not overwrite
+  each other's changes.
+
+  Args:
+    key: the key of the SearchPosting shard
+    page_id: id of the page being indexed
+    weight: the page's weight for the term, or None to remove it
+
+  """
+  def txn():
+    """Re-reads the shard and replaces the page's entry."""
+    posting = SearchPosting.get(key)
+    if posting is None:
+      posting = SearchPosting(key=key)
+    if page_id in posting.page_ids:
+      index = posting.page_ids.index(page_id)
+      del posting.page_ids[index]
+      del posting.weights[index]
+    if weight is not None:
+      posting.page_ids.append(page_id)
+      posting.weights.append(weight)
+    if posting.page_ids:
+      posting.put()
+    elif posting.is_saved():
+      posting.delete()
+
+  db.run_in_transaction(txn)
+
+
+def _update_postings(page_id, weights):
+  """Replaces the postings of a page with the given term weights.
+
+  The shards are first read together, and only those whose entry for the page
+  changes are updated, each in its own transaction.
+
+  Args:
+    page_id: id of the page being indexed
+    weights: dict mapping each term to its weight, empty to unindex the page
+
+  """
+  document_key = db.Key.from_path('SearchDocument', str(page_id))
+  document = SearchDocument.get(document_key)
+  terms = set(weights)
+  if document is not None:
+    terms.update(document.terms)
+  terms = list(terms)
+
+  keys = [_posting_key(term, page_id) for term in terms]
+  postings = []
+  for batch in _batches(keys):
+    postings.extend(db.get(batch))
+
+  for term, key, posting in zip(terms, keys, postings):
+    old_weight = None
+    if posting is not None and page_id in posting.page_ids:
+      old_weight = posting.weights[posting.page_ids.index(page_id)]
+    if old_weight != weights.get(term):
+      _set_weight(key, page_id, weights.get(term))
+
+  if weights:
+    SearchDocument(key=document_key, terms=list(weights)).put()
+  elif document is not None:
+    document.delete()
+
+
+def index_page(page):
+  """Adds a page's title and content to the index, replacing older entries.
+
+  Args:
+    page: the saved Page to index
+
+  """
+  weights = {}
+  for term in tokenize(page.title):
+    weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+  for term in tokenize(page.content):
+    weights[term] = weights.get(term, 0) + 1
+  _update_postings(page.key().id(), weights)
+
+
+def queue_update(page_id):
+  """Updates the index for a saved or deleted page from a task.
+
+  The task is queued once the current changes are written, and handles
+  every page queued until then.
+
+  Args:
+    page_id: id of the page that was saved or deleted
+
+  """
+  _pending.add(page_id)
+  unitofwork.after_commit(_queue_pending)
+
+
+def _queue_pending():
+  """Queues a task updating the index for the pending pages."""
+  if not _pending:
+    return
+  page_ids = ','.join(str(page_id) for page_id in sorted(_pending))
+  _pending.clear()
+  taskqueue.add(url=urlresolvers.reverse('views.tasks.reindex_search'),
+                params={'page_ids': page_ids})
+
+
+def update_pages(page_ids):
+  """Indexes the pages with the given ids, unindexing those since deleted.
+
+  Args:
+    page_ids: a list of page ids
+
+  """
+  for page_id, page in zip(page_ids, models.Page.get_by_id(page_ids)):
+    if page is None:
+      _update_postings(page_id, {})
+    else:
+      index_page(page)
+
+
+def reindex_batch(cursor=None):
+  """Indexes the next batch of pages.
+
+  Args:
+    cursor: the cursor returned by the previous batch, or None to start
+
+  Returns:
+    The cursor to continue from, or None once every page is indexed
+
+  """
+  query = models.Page.all()
+  if cursor:
+    query.with_cursor(cursor)
+  pages = query.fetch(REINDEX_BATCH_SIZE)
+  for page in pages:
+    index_page(page)
+  if len(pages) < REINDEX_BATCH_SIZE:
+    return None
+  return query.cursor()
+
+
+def _rank(terms):
+  """Finds the pages containing every term, best matches first.
+
+  Pages are scored by the sum of each term's weight on the page times its
+  inverse document frequency.
+
+  Args:
+    terms: list of distinct search terms
+
+  Returns:
+    A list of page ids
+
+  """
+  keys = [db.Key.from_path('SearchPosting', u'%s:%d' % (term, shard))
+          for term in terms for shard in range(POSTING_SHARDS)]
+  postings = db.get(keys)
+  page_count = max(snapshot.current().page_count, 1)
+
+  scores = None
+  for i, term in enumerate(terms):
+    term_weights = {}
+    for posting in postings[i * POSTING_SHARDS:(i + 1) * POSTING_SHARDS]:
+      if posting is not None:
+        term_weights.update(zip(posting.page_ids, posting.weights))
+    if not term_weights:
+      return []
+
+    idf = math.log(1.0 + float(page_count) / len(term_weights))
+    if scores is None:
+      scores = dict((page_id, weight * idf)
+                    for page_id, weight in term_weights.iteritems())
+    else:
+      scores = dict((page_id, score + term_weights[page_id] * idf)
+                    for page_id, score in scores.iteritems()
+                    if page_id in term_weights)
+
+  return sorted(scores, key=scores.get, reverse=True)
+
+
+def search(query, profile, page_number=0):
+  """Searches the pages a user can read.
+
+  The ranked page ids for a query are cached and shared by all users; each
+  page of results is then cut from them after filtering by the user's access
+  rights against the site snapshot.
+
+  Args:
+    query: the text entered by the user
+    profile: the UserProfile of the user searching, or None
+    page_number: which page of results to return, starting at 0
+
+  Returns:
+    A tuple of the list of PageRecord objects on the requested page of
+    results and the total number of results
+
+  """
+  terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+  if not terms:
+    return [], 0
+
+  key = 'search:%s' % ' '.join(terms)
+  ranked = utility.memcache_get(key)
+  if ranked is None:
+    ranked = _rank(terms)
+    utility.memcache_set(key, ranked)
+
+  site = snapshot.current()
+  can_read = site.reader(profile)
+  results = []
+  for page_id in ranked:
+    record = site.page(page_id)
+    if record is not None and record.path is not None and can_read(record):
+      results.append(record)
+
+  start = page_number * RESULTS_PER_PAGE
+  return results[start:start + RESULTS_PER_PAGE], len(results)
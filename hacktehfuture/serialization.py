@@ -0,0 +1,143 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compact serialization of values stored in the memcache.
+
+Pickling a db.Model instance stores the whole Python object, including
+resolved references and other cached attributes, and is slow to unpickle.
+Model instances, and lists of them, are instead stored as their datastore
+protocol buffers, which hold exactly the stored properties.  The references a
+model lists in CACHED_REFERENCES are stored the same way along with the
+instance, if they were already resolved, and set again when it is read, so
+they cost no datastore get.  Every value is
+prefixed with a schema version so entries written by older code read as
+misses, and values larger than COMPRESSION_THRESHOLD are zlib-compressed.
+
+"""
+
+import cPickle as pickle
+import zlib
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+
+# Bump this when the encoding changes; older entries are then ignored.
+SCHEMA_VERSION = 2
+
+# Serialized values larger than this many bytes are compressed.
+COMPRESSION_THRESHOLD = 4096
+
+_PLAIN = 0
+_ENTITY = 1
+_ENTITY_LIST = 2
+
+_RAW = 'r'
+_COMPRESSED = 'z'
+
+
+def _resolved_references(entity):
+  """Returns the CACHED_REFERENCES a model instance already fetched.
+
+  Returns:
+    A dict from property name to model instance
+
+  """
+  resolved = {}
+  properties = entity.properties()
+  for name in getattr(entity, 'CACHED_REFERENCES', ()):
+    # Where ReferenceProperty keeps the instance it fetched.
+    # pylint: disable-msg=W0212
+    value = getattr(entity, '_RESOLVED' + properties[name]._attr_name(), None)
+    if value is not None:
+      resolved[name] = value
+  return resolved
+
+
+def _entity_to_string(entity):
+  """Encodes a model instance and its resolved references.
+
+  Returns:
+    A tuple of the protocol buffer string and a dict from property name to
+    the encoded referenced instance
+
+  """
+  references = dict((name, _entity_to_string(value))
+                    for name, value in _resolved_references(entity).iteritems())
+  return db.model_to_protobuf(entity).Encode(), references
+
+
+def _entity_from_string(encoded):
+  """Decodes a model instance encoded by _entity_to_string."""
+  data, references = encoded
+  entity = db.model_from_protobuf(entity_pb.EntityProto(data))
+  for name, value in references.iteritems():
+    setattr(entity, name, _entity_from_string(value))
+  return entity
+
+
+def dumps(value):
+  """Serializes a value for the memcache.
+
+  Args:
+    value: a picklable value, a db.Model instance or a list of them
+
+  Returns:
+    A string starting with the schema version and encoding flag
+
+  """
+  if isinstance(value, db.Model):
+    value = (_ENTITY, _entity_to_string(value))
+  elif (isinstance(value, list) and value and
+        all(isinstance(item, db.Model) for item in value)):
+    value = (_ENTITY_LIST, [_entity_to_string(item) for item in value])
+  else:
+    value = (_PLAIN, value)
+
+  data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+  encoding = _RAW
+  if len(data) > COMPRESSION_THRESHOLD:
+    data = zlib.compress(data)
+    encoding = _COMPRESSED
+  return '%s%s%s' % (chr(SCHEMA_VERSION), encoding, data)
+
+
+def loads(data):
+  """Deserializes a value written by dumps().
+
+  Args:
+    data: the string read from the memcache, or None
+
+  Returns:
+    The original value, or None if data is missing or from another schema
+
+  """
+  if not isinstance(data, str) or len(data) < 2:
+    return None
+  if ord(data[0]) != SCHEMA_VERSION:
+    return None
+
+  encoding, data = data[1], data[2:]
+  if encoding == _COMPRESSED:
+    data = zlib.decompress(data)
+  kind, value = pickle.loads(data)
+
+  if kind == _ENTITY:
+    return _entity_from_string(value)
+  if kind == _ENTITY_LIST:
+    return [_entity_from_string(item) for item in value]
+  return value
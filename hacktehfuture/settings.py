@@ -23,7 +23,13 @@ APPEND_SLASH = False
 DEBUG = os.environ['SERVER_SOFTWARE'].startswith('Dev')
 LANGUAGE_CODE = 'en-us'
 MIDDLEWARE_CLASSES = (
+    # First, so that it compresses the response after all other middleware.
+    'middleware.GZipMiddleware',
+    # Before anything that loads data, so that refusals stay cheap.
+    'middleware.RateLimitMiddleware',
     'middleware.AddUserToRequestMiddleware',
+    # Last, so that it writes the view's changes before the response is sent.
+    'middleware.UnitOfWorkMiddleware',
 )
 ROOT_PATH = os.path.dirname(__file__)
 ROOT_URLCONF = 'urls'
@@ -33,5 +39,5 @@ TEMPLATE_DIRS = (
     os.path.join(os.path.dirname(__file__), 'templates'),
 )
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.load_template_source',
+    'template_loader.Loader',
 )
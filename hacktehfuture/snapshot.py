@@ -0,0 +1,366 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Instance-resident snapshot of the site graph.
+
+The page tree, its access control lists, the sidebar and the redirects left
+by moved pages are small and change rarely compared with how often they are
+read.  A SiteSnapshot holds a compact, immutable copy of all of them so that
+path resolution, redirects, breadcrumbs, the tree view and sidebar visibility
+can be answered without any RPCs.  The snapshot is
+replaced as a whole whenever the cache generation changes, or only that of
+its SCOPE, as when an attachment is added.
+
+"""
+
+import hashlib
+
+import models
+import utility
+
+
+# Changed whenever the rows read by _load_rows change shape.
+SNAPSHOT_KEY = 'site-snapshot:2'
+
+# The utility.GENERATION_SCOPES entry the snapshot is cached in, so that
+# changes that only affect it can rebuild it without clearing the cache.
+SCOPE = 'snapshot'
+
+
+class AclRecord(object):
+  # pylint: disable-msg=R0903
+  """Compact copy of an AccessControlList, holding ids instead of keys."""
+
+  __slots__ = ('global_read', 'global_write', 'user_read', 'user_write',
+               'group_read', 'group_write')
+
+  def __init__(self, global_read, global_write, user_read, user_write,
+               group_read, group_write):
+    # pylint: disable-msg=R0913
+    self.global_read = bool(global_read)
+    self.global_write = bool(global_write)
+    self.user_read = frozenset(user_read)
+    self.user_write = frozenset(user_write)
+    self.group_read = frozenset(group_read)
+    self.group_write = frozenset(group_write)
+
+  def allows_write(self, user_id, group_ids):
+    """Determines if the user or one of their groups may write."""
+    return (self.global_write or user_id in self.user_write or
+            bool(self.group_write & group_ids))
+
+  def allows_read(self, user_id, group_ids):
+    """Determines if the user or one of their groups may read."""
+    return (self.global_read or user_id in self.user_read or
+            bool(self.group_read & group_ids) or
+            self.allows_write(user_id, group_ids))
+
+
+class PageRecord(object):
+  # pylint: disable-msg=R0903
+  """Compact copy of the navigational fields of a Page."""
+
+  __slots__ = ('id', 'name', 'title', 'parent', 'path', 'acl_id', 'children',
+               'files')
+
+  kind = 'Page'
+
+  def __init__(self, page_id, name, title):
+    self.id = page_id
+    self.name = name
+    self.title = title
+    self.parent = None
+    self.path = None
+    self.acl_id = None
+    self.children = []
+    self.files = []
+
+
+class FileRecord(object):
+  # pylint: disable-msg=R0903
+  """Compact copy of the navigational fields of a FileStore."""
+
+  __slots__ = ('id', 'name', 'page', 'path', 'acl_id', 'is_hidden')
+
+  kind = 'FileStore'
+
+  def __init__(self, file_id, name, page, path, acl_id, is_hidden):
+    # pylint: disable-msg=R0913
+    self.id = file_id
+    self.name = name
+    self.page = page
+    self.path = path
+    self.acl_id = acl_id
+    self.is_hidden = is_hidden
+
+
+class SiteSnapshot(object):
+  """Immutable view of every page, file, ACL, redirect and the sidebar.
+
+  Page and file paths use the same format as File.path: names joined and
+  terminated by slashes, with the root page at ''.  Lookups by path take the
+  path without leading or trailing slashes.
+
+  """
+
+  __slots__ = ('generation', 'root', 'sidebar', 'sidebar_page_ids',
+               'sidebar_version', '_acls', '_files', '_pages', '_paths',
+               '_redirects')
+
+  def __init__(self, generation, rows):
+    page_rows, file_rows, acl_rows, sidebar_rows, redirect_rows = rows
+    self.generation = generation
+    self.root = None
+    self.sidebar = sidebar_rows
+    self.sidebar_page_ids = frozenset(page_id for _, items in sidebar_rows
+                                      for page_id, _ in items)
+    self.sidebar_version = hashlib.md5(repr(sidebar_rows)).hexdigest()[:8]
+    self._acls = dict((row[0], AclRecord(*row[1:])) for row in acl_rows)
+    self._files = {}
+    self._pages = {}
+    self._paths = {}
+    self._redirects = dict(redirect_rows)
+
+    own_acls = {}
+    for page_id, name, title, _, acl_id in page_rows:
+      self._pages[page_id] = PageRecord(page_id, name, title)
+      own_acls[page_id] = acl_id
+
+    for page_id, _, _, parent_id, _ in page_rows:
+      record = self._pages[page_id]
+      if parent_id is None:
+        self.root = record
+      elif parent_id in self._pages:
+        record.parent = self._pages[parent_id]
+        record.parent.children.append(record)
+
+    # Walk down from the root so that pages cut off from it get no path.
+    pending = []
+    if self.root is not None:
+      self.root.path = ''
+      self.root.acl_id = own_acls[self.root.id]
+      pending.append(self.root)
+    while pending:
+      record = pending.pop()
+      self._paths[record.path.strip('/')] = record
+      for child in record.children:
+        child.path = '%s%s/' % (record.path, child.name)
+        child.acl_id = own_acls[child.id] or record.acl_id
+        pending.append(child)
+
+    # Attachments shadow child pages of the same name, as in get_url.
+    for file_id, name, page_id, acl_id, is_hidden in file_rows:
+      page = self._pages.get(page_id)
+      if page is None or page.path is None:
+        continue
+      record = FileRecord(file_id, name, page, '%s%s/' % (page.path, name),
+                          acl_id or page.acl_id, is_hidden)
+      self._files[file_id] = record
+      page.files.append(record)
+      self._paths[record.path.strip('/')] = record
+
+  @property
+  def page_count(self):
+    """Returns the number of pages on the site."""
+    return len(self._pages)
+
+  def resolve(self, path):
+    """Returns the PageRecord or FileRecord for a path, or None."""
+    return self._paths.get(path)
+
+  def redirect_target(self, path):
+    """Finds where a path that no longer exists has moved to.
+
+    The longest prefix of the path that a page was moved away from is
+    replaced by the current path of that page.
+
+    Args:
+      path: the requested path without leading or trailing slashes
+
+    Returns:
+      The URL to redirect to, or None if the path never belonged to a page
+
+    """
+    parts = path.split('/')
+    for i in range(len(parts), 0, -1):
+      page_id = self._redirects.get('/'.join(parts[:i]))
+      if page_id is None:
+        continue
+      record = self._pages.get(page_id)
+      if record is None or record.path is None:
+        return None
+      target = '/%s%s' % (record.path, '/'.join(parts[i:]))
+      if target.strip('/') == path:
+        # A stale redirect to where the path already is.
+        return None
+      return target
+    return None
+
+  def redirects_under(self, path):
+    """Returns the redirects from a path and the paths beneath it.
+
+    Returns:
+      A list of (old path, page id) tuples
+
+    """
+    prefix = path + '/'
+    return [(old_path, page_id)
+            for old_path, page_id in self._redirects.iteritems()
+            if old_path == path or old_path.startswith(prefix)]
+
+  def page(self, page_id):
+    """Returns the PageRecord for a page id, or None."""
+    return self._pages.get(page_id)
+
+  def file(self, file_id):
+    """Returns the FileRecord for a file id, or None."""
+    return self._files.get(file_id)
+
+  def descendants(self, page_id):
+    """Returns the records of every page and file beneath a page.
+
+    The files attached to the page itself are included, the page is not.
+
+    """
+    record = self._pages.get(page_id)
+    if record is None:
+      return []
+    records = list(record.files)
+    pending = list(record.children)
+    while pending:
+      record = pending.pop()
+      records.append(record)
+      records.extend(record.files)
+      pending.extend(record.children)
+    return records
+
+  def breadcrumbs(self, page_id):
+    """Returns the breadcrumbs leading to a page, root first.
+
+    Returns:
+      A list of dicts with the 'path' and 'name' of each ancestor
+
+    """
+    breadcrumbs = []
+    record = self._pages.get(page_id)
+    while record is not None and record.parent is not None:
+      record = record.parent
+      breadcrumbs.append({'path': '/' + record.path, 'name': record.name})
+    breadcrumbs.reverse()
+    return breadcrumbs
+
+  def is_public(self, record):
+    """Determines if anyone, signed in or not, can read a record."""
+    acl = self._acls.get(record.acl_id)
+    return acl is not None and acl.global_read
+
+  def reader(self, profile):
+    """Returns a predicate telling whether a profile can read a record.
+
+    The profile's group membership is resolved once, so the predicate can be
+    applied to a whole tree without further lookups.
+
+    Args:
+      profile: UserProfile of the reader, or None for anonymous users
+
+    Returns:
+      A function taking a PageRecord or FileRecord and returning a bool
+
+    """
+    if profile is not None and profile.is_superuser:
+      return lambda record: True
+
+    user_id = None
+    group_ids = frozenset()
+    if profile is not None:
+      user_id = profile.key().id()
+      group_ids = profile.group_ids
+
+    def can_read(record):
+      """Checks the record's effective ACL."""
+      acl = self._acls.get(record.acl_id)
+      return acl is not None and acl.allows_read(user_id, group_ids)
+
+    return can_read
+
+
+def _reference_id(prop, entity):
+  """Returns the id an entity's reference points to without fetching it."""
+  key = prop.get_value_for_datastore(entity)
+  return key and key.id()
+
+
+def _load_rows():
+  """Reads the site graph from the datastore as plain tuples."""
+  # moves needs the snapshot to move pages.
+  import moves
+  page_rows = [(page.key().id(), page.name, page.title,
+                _reference_id(models.Page.parent_page, page),
+                _reference_id(models.Page.acl_data, page))
+               for page in models.Page.all()]
+
+  file_rows = [(file_store.key().id(), file_store.name,
+                _reference_id(models.FileStore.parent_page, file_store),
+                _reference_id(models.FileStore.acl_data, file_store),
+                file_store.is_hidden)
+               for file_store in models.FileStore.all()]
+
+  def ids(keys):
+    """Converts a list of keys into a tuple of ids."""
+    return tuple(key.id() for key in keys)
+
+  acl_rows = [(acl.key().id(), acl.global_read, acl.global_write,
+               ids(acl.user_read), ids(acl.user_write),
+               ids(acl.group_read), ids(acl.group_write))
+              for acl in models.AccessControlList.all()]
+
+  sidebar_rows = []
+  sidebar = models.Sidebar.load()
+  if sidebar is not None:
+    for heading, items in sidebar.get_sections():
+      sidebar_rows.append((heading, tuple((page_id, title)
+                                          for page_id, title in items)))
+
+  redirect_rows = tuple((redirect.key().name(), redirect.page_id)
+                        for redirect in moves.PathRedirect.all())
+
+  return (page_rows, file_rows, acl_rows, tuple(sidebar_rows),
+          redirect_rows)
+
+
+def current():
+  """Returns the snapshot for the current cache generation.
+
+  The snapshot is kept on the instance and rebuilt, from memcache if another
+  instance already did the work, once the generation changes.  The new
+  snapshot replaces the old one in a single assignment, so readers never see
+  a partially built graph.
+
+  Returns:
+    A SiteSnapshot object
+
+  """
+  site = utility.local_cache_get(SNAPSHOT_KEY, SCOPE)
+  if site is None:
+    rows = utility.memcache_get(SNAPSHOT_KEY, SCOPE)
+    if rows is None:
+      rows = _load_rows()
+      utility.memcache_set(SNAPSHOT_KEY, rows, scope=SCOPE)
+    site = utility.local_cache_set(
+        SNAPSHOT_KEY, SiteSnapshot(utility.cache_generation(SCOPE), rows),
+        SCOPE)
+  return site
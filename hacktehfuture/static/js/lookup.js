@@ -0,0 +1,63 @@
+/*
+ * Copyright 2008 Google Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/**
+ * Suggests users or groups in a text input as the start of one is typed.
+ * Requires dojo.
+ * @param {String} inputId The id of the text input
+ * @param {String} kind Either 'user' or 'group'
+ * @param {Object} extraArgs Further GET parameters for the lookup, such as
+ *     the page_id the input belongs to
+ */
+function attachLookup(inputId, kind, extraArgs) {
+  var input = dojo.byId(inputId);
+  var list = document.createElement('datalist');
+  list.id = inputId + '_matches';
+  input.parentNode.appendChild(list);
+  input.setAttribute('list', list.id);
+  input.setAttribute('autocomplete', 'off');
+
+  var lastPrefix = '';
+  dojo.connect(input, 'onkeyup', function() {
+    var prefix = input.value;
+    if (prefix == lastPrefix) {
+      return;
+    }
+    lastPrefix = prefix;
+    if (!prefix) {
+      list.innerHTML = '';
+      return;
+    }
+    var args = dojo.mixin({kind: kind, q: prefix}, extraArgs || {});
+    dojo.xhrGet({
+      url: '/admin/lookup/',
+      content: args,
+      handleAs: 'json',
+      load: function(matches) {
+        if (prefix != lastPrefix) {
+          return;
+        }
+        list.innerHTML = '';
+        dojo.forEach(matches, function(match) {
+          var option = document.createElement('option');
+          option.value = match.value;
+          option.appendChild(document.createTextNode(match.label));
+          list.appendChild(option);
+        });
+      }
+    });
+  });
+}
@@ -0,0 +1,105 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Template loader that keeps compiled templates on the instance.
+
+The filesystem loader reads and parses a template, and every template it
+extends, on each render.  This loader keeps the compiled Template objects for
+the lifetime of the instance, keyed by theme and template name, and drops them
+all when a new version of the application is deployed.
+
+"""
+
+import logging
+import os
+
+import configuration
+from django.conf import settings
+from django.template import loader
+from django.template.loaders import filesystem
+
+
+class Loader(loader.BaseLoader):
+  """Caches compiled templates loaded from settings.TEMPLATE_DIRS."""
+
+  is_usable = True
+
+  def __init__(self, *args, **kwargs):
+    super(Loader, self).__init__(*args, **kwargs)
+    self._source_loader = filesystem.Loader()
+    self._templates = {}
+    self._version = None
+
+  def load_template_source(self, template_name, template_dirs=None):
+    """Reads the source of a template from the filesystem."""
+    return self._source_loader.load_template_source(template_name,
+                                                    template_dirs)
+
+  def load_template(self, template_name, template_dirs=None):
+    """Returns the compiled template, compiling it on first use.
+
+    Templates are not cached on the development server so that edits show up
+    without a restart.
+
+    """
+    if settings.TEMPLATE_DEBUG:
+      return super(Loader, self).load_template(template_name, template_dirs)
+
+    version = os.environ.get('CURRENT_VERSION_ID')
+    if version != self._version:
+      self._templates.clear()
+      self._version = version
+
+    if template_dirs:
+      template_dirs = tuple(template_dirs)
+    key = (configuration.SYSTEM_THEME_NAME, template_name, template_dirs)
+    template = self._templates.get(key)
+    if template is None:
+      template, display_name = super(Loader, self).load_template(
+          template_name, template_dirs)
+      if not hasattr(template, 'render'):
+        # The source could not be compiled on its own; let Django handle it.
+        return template, display_name
+      self._templates[key] = template
+    return template, None
+
+  def reset(self):
+    """Forgets all compiled templates."""
+    self._templates.clear()
+
+
+def precompile():
+  """Compiles every template so the first real request finds them cached.
+
+  Returns:
+    The number of templates compiled
+
+  """
+  count = 0
+  for template_dir in settings.TEMPLATE_DIRS:
+    for dir_path, _, file_names in os.walk(template_dir):
+      for file_name in file_names:
+        if not file_name.endswith('.html'):
+          continue
+        name = os.path.join(dir_path, file_name)[len(template_dir):]
+        name = name.lstrip(os.sep).replace(os.sep, '/')
+        try:
+          loader.get_template(name)
+          count += 1
+        except Exception, err:  # pylint: disable-msg=W0703
+          logging.warning('Could not compile template %s: %s', name, err)
+  return count
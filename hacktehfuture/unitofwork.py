@@ -0,0 +1,207 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Batching the writes made while handling a request.
+
+UnitOfWorkMiddleware starts a unit of work for every request.  Saving a model
+through its put() override only adds the entities to the unit, which writes
+all of them in batches once the view has returned; a single batch within
+one entity group is written in a transaction.  The cache is invalidated once
+afterwards if any of the writes asked for it, even if a batch failed, and work
+that needs the entities to be stored, such as indexing or queueing tasks, runs
+last.  If the view raises, nothing collected is written; new entities, which
+models write at once so that they have a key, and deletions are not undone.
+
+An entity added more than once is written once, as it was last added, which
+is what writing it each time would have left in the datastore.  Outside a
+request, for instance in tasks run from the shell, put() and invalidate()
+write and invalidate immediately.
+
+"""
+
+import logging
+
+from google.appengine.ext import db
+import utility
+
+
+# Most entities written or deleted by one datastore call.
+BATCH_SIZE = 500
+
+
+class UnitOfWork(object):
+  """The writes, invalidation and follow-up work collected for a request."""
+
+  def __init__(self):
+    self.entities = []
+    self.positions = {}
+    self.deleted = {}
+    self.invalidate = False
+    self.callbacks = []
+
+  def add(self, entities):
+    """Adds entities to be written, replacing earlier copies of the same key.
+
+    Args:
+      entities: a list of model instances
+
+    """
+    for entity in entities:
+      key = None
+      if entity.has_key():
+        key = str(entity.key())
+        self.deleted.pop(key, None)
+      if key in self.positions:
+        self.entities[self.positions[key]] = entity
+      else:
+        if key is not None:
+          self.positions[key] = len(self.entities)
+        self.entities.append(entity)
+
+  def remove(self, keys):
+    """Adds keys to be deleted, dropping earlier writes of the same keys.
+
+    Args:
+      keys: a list of db.Key
+
+    """
+    for key in keys:
+      position = self.positions.pop(str(key), None)
+      if position is not None:
+        self.entities[position] = None
+      self.deleted[str(key)] = key
+
+  def commit(self):
+    """Writes the entities, then invalidates the cache and runs callbacks.
+
+    Raises:
+      db.Error: A batch could not be written; earlier batches were
+
+    """
+    entities = [entity for entity in self.entities if entity is not None]
+    try:
+      if len(entities) <= BATCH_SIZE and _in_one_entity_group(entities):
+        db.run_in_transaction(db.put, entities)
+      else:
+        for batch in _batches(entities):
+          db.put(batch)
+      for batch in _batches(self.deleted.values()):
+        db.delete(batch)
+    finally:
+      if self.invalidate:
+        utility.clear_memcache()
+    for func, args, kwds in self.callbacks:
+      func(*args, **kwds)  # pylint: disable-msg=W0142
+
+
+# The unit of work of the request being handled, if any.
+_current = []
+
+
+def _batches(items):
+  """Splits a list into slices of at most BATCH_SIZE items."""
+  return [items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)]
+
+
+def _entity_group(entity):
+  """Returns the root key of the entity group of an entity, or None."""
+  key = entity.parent_key()
+  if key is None and entity.has_key():
+    key = entity.key()
+  while key is not None and key.parent() is not None:
+    key = key.parent()
+  return key
+
+
+def _in_one_entity_group(entities):
+  """Determines if a transaction can write all of the entities."""
+  if not entities:
+    return False
+  roots = set(_entity_group(entity) for entity in entities)
+  return len(entities) == 1 or (len(roots) == 1 and None not in roots)
+
+
+def begin():
+  """Starts collecting writes, discarding any left over from a request."""
+  del _current[:]
+  _current.append(UnitOfWork())
+
+
+def commit():
+  """Writes everything collected since begin()."""
+  if _current:
+    work = _current.pop()
+    work.commit()
+
+
+def rollback():
+  """Discards everything collected since begin()."""
+  if _current and _current[-1].entities:
+    logging.info('Discarding %d unwritten entities', len(_current[-1].entities))
+  del _current[:]
+
+
+def put(entities, invalidate=True):
+  """Writes entities as part of the current unit of work.
+
+  Args:
+    entities: a list of model instances
+    invalidate: False if the entities do not affect any cached data
+
+  """
+  if not _current:
+    db.put(entities)
+    if invalidate:
+      utility.clear_memcache()
+    return
+  _current[-1].add(entities)
+  if invalidate:
+    _current[-1].invalidate = True
+
+
+def delete(keys, invalidate=True):
+  """Deletes entities as part of the current unit of work.
+
+  Args:
+    keys: a list of db.Key
+    invalidate: False if the entities do not affect any cached data
+
+  """
+  if not _current:
+    db.delete(keys)
+    if invalidate:
+      utility.clear_memcache()
+    return
+  _current[-1].remove(keys)
+  if invalidate:
+    _current[-1].invalidate = True
+
+
+def invalidate():
+  """Invalidates the cache once the current unit of work is written."""
+  if _current:
+    _current[-1].invalidate = True
+  else:
+    utility.clear_memcache()
+
+
+def after_commit(func, *args, **kwds):
+  """Calls func(*args, **kwds) once the current unit of work is written."""
+  if _current:
+    _current[-1].callbacks.append((func, args, kwds))
+  else:
+    func(*args, **kwds)  # pylint: disable-msg=W0142
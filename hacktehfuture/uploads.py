@@ -0,0 +1,258 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Storing uploaded attachments, in one request or in resumable pieces.
+
+Files larger than CHUNK_SIZE are written as FileStoreChunk entities one
+piece at a time, so no request holds more than one piece in a datastore
+call.  A client can also send a file over several requests: it starts an
+UploadSession, appends pieces at the byte offset the session has received so
+far, and finishes the session once every byte has arrived.  After an
+interruption the client asks for the received offset and carries on from
+there.
+
+"""
+
+import datetime
+import hashlib
+
+from google.appengine.ext import db
+import compression
+import configuration
+import models
+import snapshot
+import unitofwork
+import utility
+
+
+# Largest piece stored in one FileStoreChunk, safely below the entity limit.
+CHUNK_SIZE = 900 * 1024
+
+# Sessions not finished within this time are deleted with their chunks.
+SESSION_LIFETIME = datetime.timedelta(days=1)
+
+# Number of chunks read per batched get while hashing a finished session.
+_HASH_BATCH_SIZE = 4
+
+
+class UploadSession(db.Model):
+  # pylint: disable-msg=R0904
+  """An attachment being uploaded over several requests.
+
+  The chunks received so far are children of the session, keyed by their
+  byte offset, so that a piece sent twice overwrites itself.
+
+  """
+
+  page_id = db.IntegerProperty(required=True)
+  name = db.StringProperty(required=True)
+  is_hidden = db.BooleanProperty(default=False)
+  received = db.IntegerProperty(default=0)
+  chunks = db.ListProperty(db.Key, indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+def store_stream(pieces):
+  """Stores a file read piece by piece as FileStoreChunk entities.
+
+  Args:
+    pieces: an iterable of strings no larger than CHUNK_SIZE
+
+  Returns:
+    The key of the FileStoreData, which the caller holds a reference to
+
+  """
+  digest = hashlib.sha1()
+  chunk_keys = []
+  for piece in pieces:
+    digest.update(piece)
+    chunk_keys.append(models.FileStoreChunk(data=db.Blob(piece)).put())
+  return models.FileStoreData.acquire_chunks(digest.hexdigest(), chunk_keys)
+
+
+def store_upload(uploaded_file, name):
+  """Stores a file uploaded in a single request.
+
+  Args:
+    uploaded_file: the Django UploadedFile
+    name: the name the file is attached under
+
+  Returns:
+    The key of the FileStoreData, which the caller holds a reference to
+
+  """
+  if uploaded_file.size <= CHUNK_SIZE:
+    return models.FileStoreData.acquire(
+        uploaded_file.read(), compression.is_compressible_name(name))
+  return store_stream(uploaded_file.chunks(CHUNK_SIZE))
+
+
+def save_attachment(page, name, is_hidden, data_key=None, url=None):
+  """Creates or updates an attachment with a single write.
+
+  Only the cached entries the change can show up in are invalidated, once it
+  is written: the page's file list and body when the attachment is new or
+  its link or visibility changes, and the site snapshot when it is new or its
+  visibility changes.  New contents for an existing file invalidate nothing.
+
+  Args:
+    page: the Page to attach the file to
+    name: the name of the file
+    is_hidden: True if the file is not listed when the page is viewed
+    data_key: key of the FileStoreData the caller holds a reference to
+    url: the link to store instead of data
+
+  Returns:
+    The saved FileStore
+
+  """
+  file_record = page.get_attachment(name)
+  listed = file_record is None or file_record.is_hidden != is_hidden
+  shown = listed or file_record.url_data is not None or url is not None
+  if file_record is None:
+    file_record = models.FileStore(name=name, parent_page=page)
+
+  if url:
+    file_record.url = url
+  else:
+    file_record.set_data_key(data_key)
+  file_record.is_hidden = is_hidden
+  file_record.put(invalidate=False)
+  if shown:
+    _invalidate_page(page, name, listed)
+  return file_record
+
+
+def _invalidate_page(page, name, listed):
+  """Drops the cached data of a page once a change to an attachment is written.
+
+  Args:
+    page: the Page the attachment belongs to
+    name: the name of the attachment
+    listed: True if the site snapshot has to be rebuilt too
+
+  """
+  page_id = page.key().id()
+  keys = ['file-list:%d' % page_id,
+          'page-body:%s:%d' % (configuration.SYSTEM_THEME_NAME, page_id)]
+  record = snapshot.current().page(page_id)
+  if record is not None and record.path is not None:
+    keys.append('missing-path:%s' % ('%s%s' % (record.path, name)).strip('/'))
+  unitofwork.after_commit(utility.memcache_delete, keys)
+  if listed:
+    unitofwork.after_commit(utility.clear_scope, snapshot.SCOPE)
+
+
+def start_session(page, name, is_hidden):
+  """Starts a resumable upload.
+
+  Returns:
+    The new UploadSession
+
+  """
+  session = UploadSession(page_id=page.key().id(), name=name,
+                          is_hidden=is_hidden)
+  session.put()
+  return session
+
+
+def append(session_key, offset, data):
+  """Adds the bytes starting at offset to an upload.
+
+  At most CHUNK_SIZE bytes are stored per call.
+
+  Args:
+    session_key: the key of the UploadSession
+    offset: the position of data in the file
+    data: the bytes received
+
+  Returns:
+    The number of bytes received so far, which is the offset to send next.
+    If data was not at the expected offset it is ignored.
+
+  """
+  data = data[:CHUNK_SIZE]
+
+  def txn():
+    """Stores the chunk and advances the session in one entity group."""
+    session = UploadSession.get(session_key)
+    if session.received != offset or not data:
+      return session.received
+    chunk = models.FileStoreChunk(parent=session_key,
+                                  key_name='%012d' % offset,
+                                  data=db.Blob(data))
+    session.chunks.append(chunk.put())
+    session.received += len(data)
+    session.put()
+    return session.received
+
+  return db.run_in_transaction(txn)
+
+
+def finish(session):
+  """Attaches a completed upload to its page and ends the session.
+
+  Args:
+    session: the UploadSession with every byte received
+
+  Returns:
+    The saved FileStore, or None if the page no longer exists
+
+  """
+  page = models.Page.get_by_id(session.page_id)
+  if page is None:
+    discard(session)
+    return None
+
+  if not session.chunks:
+    data_key = None
+  elif len(session.chunks) == 1:
+    data = models.FileStoreChunk.get(session.chunks[0]).data
+    data_key = models.FileStoreData.acquire(
+        data, compression.is_compressible_name(session.name))
+    db.delete(session.chunks)
+  else:
+    digest = hashlib.sha1()
+    for i in range(0, len(session.chunks), _HASH_BATCH_SIZE):
+      for chunk in db.get(session.chunks[i:i + _HASH_BATCH_SIZE]):
+        digest.update(chunk.data)
+    data_key = models.FileStoreData.acquire_chunks(digest.hexdigest(),
+                                                   session.chunks)
+
+  file_record = save_attachment(page, session.name, session.is_hidden,
+                                data_key=data_key)
+  unitofwork.after_commit(session.delete)
+  return file_record
+
+
+def discard(session):
+  """Deletes an unfinished upload and the chunks it received."""
+  db.delete(session.chunks + [session.key()])
+
+
+def discard_expired():
+  """Deletes a batch of sessions that were never finished.
+
+  Returns:
+    The number of sessions deleted
+
+  """
+  cutoff = datetime.datetime.utcnow() - SESSION_LIFETIME
+  sessions = UploadSession.all().filter('created <', cutoff).fetch(20)
+  for session in sessions:
+    discard(session)
+  return len(sessions)
@@ -25,6 +25,8 @@ urlpatterns = defaults.patterns(
     'views',
     (r'^admin/$', 'admin.index'),
     (r'^admin/recent/$', 'admin.recently_modified'),
+    (r'^admin/changes/$', 'admin.change_feed'),
+    (r'^admin/popular/$', 'admin.most_viewed'),
     (r'^admin/new/(\d*)$', 'admin.new_page'),
     (r'^admin/edit/sidebar/$', 'admin.edit_sidebar'),
     (r'^admin/edit/add_to_sidebar/(\d+)$', 'admin.add_to_sidebar'),
@@ -42,14 +44,30 @@ urlpatterns = defaults.patterns(
     (r'^admin/exportusers/$', 'admin.export_users'),
     (r'^admin/edit/(\d+)/$', 'admin.edit_page'),
     (r'^admin/deletepage/([^\s]+)/$', 'admin.delete_page'),
+    (r'^admin/movepage/(\d+)/$', 'admin.move_page'),
     (r'^admin/download/([\w\-]+).html$', 'admin.download_page_html'),
     (r'^admin/addfile/$', 'admin.upload_file'),
+    (r'^admin/upload/$', 'admin.start_upload'),
+    (r'^admin/upload/(\d+)/$', 'admin.upload_chunk'),
+    (r'^admin/upload/(\d+)/finish/$', 'admin.finish_upload'),
     (r'^admin/deletefile/([\w\-]+)/([^\s/]+)$', 'admin.delete_file'),
     (r'^admin/help/$', 'admin.get_help'),
     (r'^admin/memcache_info/$', 'admin.display_memcache_info'),
     (r'^admin/memcache_info/flush/$', 'admin.flush_memcache_info'),
+    (r'^admin/search/rebuild/$', 'admin.rebuild_search_index'),
+    (r'^admin/lookup/$', 'admin.lookup'),
+    (r'^admin/migrations/$', 'admin.list_migrations'),
+    (r'^_ah/warmup$', 'main.warmup'),
+    (r'^_tasks/search/reindex/$', 'tasks.reindex_search'),
+    (r'^_tasks/migrations/run/$', 'tasks.run_migration'),
+    (r'^_tasks/counters/flush/$', 'tasks.flush_counters'),
+    (r'^_tasks/moves/journal/$', 'tasks.journal_move'),
+    (r'^_tasks/uploads/discard/$', 'tasks.discard_uploads'),
+    (r'^_tasks/groups/migrate/$', 'tasks.migrate_group_members'),
+    (r'^_tasks/cache/purge/$', 'tasks.purge_cache'),
     (r'^_treedata/$', 'main.get_tree_data'),
     (r'^sitemap/$', 'main.page_list'),
+    (r'^search/$', 'main.search_pages'),
     (r'^(.*)$', 'main.get_url'),
 )
 
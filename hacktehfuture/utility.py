@@ -19,14 +19,61 @@
 
 import functools
 import logging
+import time
+import cachebackend
 import configuration
 
 from django import http
 from django import shortcuts
 from django.core import urlresolvers
-from google.appengine.api import memcache
+from django.template import loader
 from google.appengine.api import users
 import models
+import serialization
+
+
+# Per-instance cache of values derived from the datastore.  Entries are tagged
+# with the cache generation they were computed under, so they stop being used
+# as soon as an edit starts a new generation.
+_local_cache = {}
+
+# State that is only valid for the duration of the current request.
+_request_cache = {}
+
+GENERATION_KEY = 'cache-generation'
+
+# Parts of the cache with a generation of their own, so that they can be
+# invalidated without clearing the rest; see clear_scope.  Clearing the whole
+# cache also invalidates them.
+GENERATION_SCOPES = ('snapshot',)
+
+# Placeholder left in cached page bodies where per-user fragments go.
+HOLE_MARKER = '<!--hole:%s-->'
+
+
+def _add_user_params(request, params, sidebar=True):
+  """Adds the parameters describing the current user to params.
+
+  Args:
+    request: The request object
+    params: A dict of template parameters; modified in-place.
+    sidebar: False if the response does not show the sidebar, which is then
+      not rendered
+
+  """
+  if request.user:
+    params['user'] = request.user
+    params['sign_out'] = users.CreateLogoutURL('/')
+    params['is_admin'] = users.is_current_user_admin()
+  elif 'sign_in' not in params:
+    params['sign_in'] = users.CreateLoginURL(request.path)
+
+  profile = getattr(request, 'profile', None)
+  params['is_superuser'] = profile is not None and profile.is_superuser
+  if sidebar:
+    params['sidebar'] = models.Sidebar.render(profile)
+
+  params['configuration'] = configuration
 
 
 def respond(request, template, params=None):
@@ -49,22 +96,7 @@ def respond(request, template, params=None):
   if params is None:
     params = {}
 
-  if request.user:
-    params['user'] = request.user
-    params['sign_out'] = users.CreateLogoutURL('/')
-    params['is_admin'] = users.is_current_user_admin()
-  else:
-    params['sign_in'] = users.CreateLoginURL(request.path)
-
-  if hasattr(request, 'profile') and request.profile is not None:
-    profile = request.profile
-    params['sidebar'] = models.Sidebar.render(profile)
-    params['is_superuser'] = profile.is_superuser
-  else:
-    params['is_superuser'] = False
-    params['sidebar'] = models.Sidebar.render(None)
-    
-  params['configuration'] = configuration
+  _add_user_params(request, params)
 
   if not template.endswith('.html'):
     template += '.html'
@@ -72,6 +104,67 @@ def respond(request, template, params=None):
   return shortcuts.render_to_response(template, params)
 
 
+def respond_with_holes(request, template, cache_key, params, holes,
+                       fragment_params=None):
+  """Renders a response from a shared cached body and per-user fragments.
+
+  The template is rendered once with a marker in place of each per-user
+  fragment, which the template outputs with {{ holes.<name>|safe }}.  That
+  body is the same for every user and is cached under cache_key.  Each
+  response then only renders the small fragment templates for the current
+  user and substitutes them into the cached body.  The per-user sidebar is
+  only rendered when the body has a sidebar hole to put it in.
+
+  Args:
+    request: The request object
+    template: The template name, including the '.html' extension.
+    cache_key: The memcache key of the shared body
+    params: A dict of template parameters that do not depend on the user;
+      modified in-place.
+    holes: A dict mapping each fragment name to the template rendering it
+    fragment_params: An optional dict of parameters only the fragments use
+
+  Returns:
+    A HttpResponse containing the assembled page.
+
+  """
+  body = memcache_get(cache_key)
+  if body is None:
+    shared_params = dict(params)
+    shared_params['configuration'] = configuration
+    shared_params['holes'] = dict((name, HOLE_MARKER % name) for name in holes)
+    body = loader.render_to_string(template, shared_params)
+    memcache_set(cache_key, body)
+
+  _add_user_params(request, params,
+                   sidebar=HOLE_MARKER % 'sidebar' in body)
+  if fragment_params:
+    params.update(fragment_params)
+  for name, fragment in holes.iteritems():
+    marker = HOLE_MARKER % name
+    if marker in body:
+      body = body.replace(marker, loader.render_to_string(fragment, params))
+
+  return cache_compressed(http.HttpResponse(body))
+
+
+def cache_compressed(response):
+  """Marks a response as one that is often sent with the same body.
+
+  The gzip middleware caches the compressed bodies of such responses instead
+  of compressing them on every request.
+
+  Args:
+    response: The HttpResponse to mark
+
+  Returns:
+    The response
+
+  """
+  response.cache_compressed = True
+  return response
+
+
 def forbidden(request, error_message=None):
   """Returns a 403 response based on a template.
 
@@ -98,6 +191,17 @@ def page_not_found(request, error_message=None):
   Returns:
     A http response with the status code of 404
   """
+  if error_message is None and not request.user:
+    # Anonymous 404s are what crawlers see; they share one cached body that
+    # signs in to the home page rather than to the missing path.
+    key = 'not-found-page'
+    content = memcache_get(key)
+    if content is None:
+      content = respond(request, '404',
+                        {'sign_in': users.CreateLoginURL('/')}).content
+      memcache_set(key, content)
+    return cache_compressed(http.HttpResponseNotFound(content))
+
   response = respond(request, '404', {'error_message': error_message})
   response.status_code = 404
   return response
@@ -124,30 +228,154 @@ def edit_updated_page(page_id, message_id='', tab_name=''):
   return http.HttpResponseRedirect(url)
 
 
-def memcache_get(key):
-  """Gets data from the memcache.
+def _generation_key(key, scope=None):
+  """Returns the cache key of an entry in the current cache generation."""
+  return '%s:%s' % (cache_generation(scope), key)
+
 
-  This method is currently in place to avoid having to disable the pylint
-  message across the codebase.
+def memcache_get(key, scope=None):
+  """Gets data from the cache backend.
+
+  Values are decoded with serialization.loads, so entries written with an
+  older schema read as misses.  Only entries set in the current cache
+  generation are seen.
+
+  Args:
+    key: the key the value was stored under
+    scope: the one of GENERATION_SCOPES the value was stored in, if any
 
   """
-  return memcache.get(key)  # pylint: disable-msg=E1101
+  return serialization.loads(
+      cachebackend.current().get(_generation_key(key, scope)))
 
 
-def memcache_set(key, val):
-  """Sets data in the memcache.
+def memcache_set(key, val, expires=0, scope=None):
+  """Sets data in the cache backend.
 
-  This method is currently in place to avoid having to disable the pylint
-  message across the codebase.
+  Values are encoded with serialization.dumps, which stores model instances
+  as protocol buffers and compresses large values.
+
+  Args:
+    key: the key to store the value under
+    val: the value to store
+    expires: optional lifetime of the entry in seconds, 0 for no expiry
+    scope: one of GENERATION_SCOPES, for a value that clear_scope invalidates
 
   """
-  return memcache.set(key, val)  # pylint: disable-msg=E1101
+  return cachebackend.current().set(_generation_key(key, scope),
+                                   serialization.dumps(val), time=expires)
+
+
+def memcache_delete(keys):
+  """Removes entries set without a scope from the current cache generation.
+
+  Used when a change only affects a few known entries, instead of clearing
+  the whole cache.
+
+  """
+  cachebackend.current().delete_multi([_generation_key(key) for key in keys])
 
 
 def clear_memcache():
-  """Flushes the memcache when an entry is edited."""
-  if not memcache.flush_all():  # pylint: disable-msg=E1101
+  """Invalidates every cached entry when an entry is edited.
+
+  Rather than flushing the cache, this starts a new cache generation, which
+  hides all entries set under the previous one; those are left to expire.
+  Data kept in the cache that is not derived from the datastore, such as
+  pending counter hits, survives.
+
+  """
+  _local_cache.clear()
+  generation = cachebackend.current().new_generation(GENERATION_KEY)
+  if generation is None:
     logging.error('Failed to clear the cache!')
+    generation = repr(time.time())
+  _request_cache[GENERATION_KEY] = generation
+
+
+def clear_scope(scope):
+  """Invalidates the entries cached in one of GENERATION_SCOPES.
+
+  Entries outside the scope are kept.
+
+  """
+  key = _scope_key(scope)
+  generation = cachebackend.current().new_generation(key)
+  if generation is None:
+    logging.error('Failed to clear the %s cache!', scope)
+    generation = repr(time.time())
+  _request_cache[key] = generation
+
+
+def start_request():
+  """Forgets any state left over from the previous request."""
+  _request_cache.clear()
+
+
+def _scope_key(scope):
+  """Returns the cache key of the generation stamp of a scope."""
+  return '%s:%s' % (GENERATION_KEY, scope)
+
+
+def cache_generation(scope=None):
+  """Returns a stamp that changes every time the cache is cleared.
+
+  The stamps live in the cache itself, so if one is evicted the next request
+  mints a new one.  The stamps of the whole cache and of every scope are read
+  together, at most once per request.
+
+  Args:
+    scope: one of GENERATION_SCOPES, to get a stamp that also changes when
+           only that scope is cleared
+
+  Returns:
+    A string identifying the current generation of cached data
+
+  """
+  keys = [GENERATION_KEY] + [_scope_key(name) for name in GENERATION_SCOPES]
+  missing = [key for key in keys if key not in _request_cache]
+  if missing:
+    cache = cachebackend.current()
+    stamps = cache.get_multi(missing)
+    for key in missing:
+      _request_cache[key] = stamps.get(key) or cache.generation(key)
+  generation = _request_cache[GENERATION_KEY]
+  if scope is not None:
+    generation = '%s.%s' % (generation, _request_cache[_scope_key(scope)])
+  return generation
+
+
+def local_cache_get(key, scope=None):
+  """Gets data from the per-instance cache.
+
+  Args:
+    key: the key the data was stored under
+    scope: the one of GENERATION_SCOPES the data was stored in, if any
+
+  Returns:
+    The cached value, or None if it is missing or from an older generation
+
+  """
+  entry = _local_cache.get(key)
+  if entry is not None and entry[0] == cache_generation(scope):
+    return entry[1]
+  return None
+
+
+def local_cache_set(key, val, scope=None):
+  """Stores data in the per-instance cache for the current generation.
+
+  Args:
+    key: the key to store the data under
+    val: the data to store
+    scope: one of GENERATION_SCOPES, for data that clear_scope invalidates
+
+  Returns:
+    The value that was stored
+
+  """
+  _local_cache[key] = (cache_generation(scope), val)
+  return val
 
 
 def flush_cache(func):
@@ -157,9 +385,7 @@ def flush_cache(func):
   def wrapper(*args, **kwargs):
     data = func(*args, **kwargs)
     logging.info('Flushing the cache')
-    _local_cache.clear()
-    if not memcache.flush_all():
-      logging.error('Memcache flush failed.')
+    clear_memcache()
     return data
 
   return wrapper
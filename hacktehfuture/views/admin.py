@@ -15,24 +15,34 @@
 # limitations under the License.
 #
 
-"""Administrative views for page editing and user management."""
+"""Administrative views for page editing and user management.
+
+This module is imported whenever URLs are reversed, including on public page
+views, so modules that only some of the views need (csv, yaml, the form
+definitions, and the upload, listing, change journal, counter, migration and
+task queue modules) are imported inside those views.
+
+"""
 
-import csv
 import functools
 import logging
-import StringIO
+import urllib
 
 from django import http
 from django.core import urlresolvers
 from django.core import validators
 from django.core import exceptions
+from django.utils import simplejson
 from django.utils import translation
-import forms
-from google.appengine.api import memcache
 from google.appengine.ext import db
 import models
+import moves
+import snapshot
 import utility
-import yaml
+
+
+# Number of changes shown on each page of the recently modified list.
+RECENT_CHANGES_PER_PAGE = 20
 
 
 def admin_required(func):
@@ -75,9 +85,84 @@ def index(request):
 
 @super_user_required
 def recently_modified(request):
-    """Show the 10 most recently modified pages."""
-    pages = models.Page.all().order('modified').fetch(10)
-    return utility.respond(request, 'admin/recently_modified', {'pages': pages})
+    """Show the most recent changes to pages, files and ACLs, newest first.
+
+    The optional GET parameters are kind, to show only one kind of entity, and
+    cursor, to continue from a previous page.
+
+    """
+    import changes
+
+    kind = request.GET.get('kind')
+    if kind not in changes.KINDS:
+        kind = None
+    records, cursor = changes.recent_changes(request.GET.get('cursor'), kind,
+                                             RECENT_CHANGES_PER_PAGE)
+
+    params = {'changes': records, 'kind': kind, 'kinds': changes.KINDS}
+    if cursor:
+        query = {'cursor': cursor}
+        if kind:
+            query['kind'] = kind
+        params['next_url'] = '%s?%s' % (
+                urlresolvers.reverse('views.admin.recently_modified'),
+                urllib.urlencode(query))
+    return utility.respond(request, 'admin/recently_modified', params)
+
+
+@super_user_required
+def change_feed(request):
+    """Returns the changes made since a point in time as JSON.
+
+    Mirrors poll this to stay in sync.  The GET parameters are:
+        since: seconds since the epoch to start after, omitted for all changes
+        cursor: the cursor from the previous response, to continue from there
+        kind: only return changes to this kind of entity
+        limit: the largest number of changes to return
+
+    The response has the list of changes and the cursor to send next time,
+    with the same since and kind.
+
+    """
+    import changes
+
+    kind = request.GET.get('kind') or None
+    if kind is not None and kind not in changes.KINDS:
+        return http.HttpResponseBadRequest('Unknown kind')
+    try:
+        since = request.GET.get('since')
+        if since:
+            since = changes.from_seconds(float(since))
+        limit = int(request.GET.get('limit', changes.MAX_CHANGES))
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError:
+        return http.HttpResponseBadRequest('Invalid since or limit')
+
+    records, cursor = changes.changes_since(request.GET.get('cursor'),
+                                            since or None, kind, limit)
+    data = {'changes': [record.to_dict() for record in records],
+            'cursor': cursor}
+    return http.HttpResponse(simplejson.dumps(data),
+                             mimetype='application/json')
+
+
+@super_user_required
+def most_viewed(request):
+    """Show the pages and files with the most views and downloads."""
+    import counters
+
+    site = snapshot.current()
+
+    def top(kind, lookup):
+        """Pairs the records of the most hit entities with their counts."""
+        return [(lookup(entity_id), count)
+                for entity_id, count in counters.totals(kind)
+                if lookup(entity_id) is not None]
+
+    return utility.respond(request, 'admin/most_viewed',
+                           {'pages': top('Page', site.page),
+                            'files': top('FileStore', site.file)})
 
 
 @super_user_required
@@ -168,6 +253,8 @@ def edit_page(request, page_id, parent_id=None):
         A Django HttpResponse object.
 
     """
+    import forms
+
     page = None
     files = None
 
@@ -208,6 +295,9 @@ def edit_page(request, page_id, parent_id=None):
                                {'form': form, 'page': page, 'files': files,
                                  'acl_data': acl_data, 'parent_id': parent_id})
 
+    old_path = None
+    if page and not page.is_root:
+        old_path = page.path
     form = forms.PageEditForm(data=request.POST, instance=page)
 
     if not form.errors:
@@ -223,6 +313,9 @@ def edit_page(request, page_id, parent_id=None):
     if parent_id and not page.parent_page:
         page.parent_page = models.Page.get_by_id(int(parent_id))
     page.put()
+    if old_path is not None:
+        # Renaming the page moved its whole subtree.
+        moves.record_move(page, old_path)
 
     return utility.edit_updated_page(page.key().id(),
                                      message_id='msgChangesSaved')
@@ -268,6 +361,8 @@ def upload_file(request):
         A http redirect to the edit form for the parent page
 
     """
+    import uploads
+
     if not request.POST or not 'page_id' in request.POST:
         return utility.page_not_found(request)
 
@@ -282,12 +377,12 @@ def upload_file(request):
     if not page.user_can_write(request.profile):
         return utility.forbidden(request)
 
-    file_data = None
+    uploaded_file = None
     file_name = None
     url = None
     if request.FILES and 'attachment' in request.FILES:
-        file_name = request.FILES['attachment'].name
-        file_data = request.FILES['attachment'].read()
+        uploaded_file = request.FILES['attachment']
+        file_name = uploaded_file.name
     elif 'url' in request.POST:
         url = request.POST['url']
         file_name = url.split('/')[-1]
@@ -304,25 +399,124 @@ def upload_file(request):
         except exceptions.ValidationError, excption:
             return utility.page_not_found(request, excption.messages[0])
 
-    file_record = page.get_attachment(file_name)
-
-    if not file_record:
-        file_record = models.FileStore(name=file_name, parent_page=page)
-
-    if file_data:
-        file_record.data = db.Blob(file_data)
+    data_key = None
+    if uploaded_file:
+        data_key = uploads.store_upload(uploaded_file, file_name)
     elif url:
-        file_record.url = db.Link(url)
+        url = db.Link(url)
 
     # Determine whether to list the file when the page is viewed
-    file_record.is_hidden = 'hidden' in request.POST
-
-    file_record.put()
-    utility.clear_memcache()
+    uploads.save_attachment(page, file_name, 'hidden' in request.POST,
+                            data_key=data_key, url=url)
 
     return utility.edit_updated_page(page_id, tab_name='files')
 
 
+def _upload_session(request, session_id):
+    """Loads an upload session the current user may write to.
+
+    Returns:
+        A tuple of the UploadSession, or None, and an error response, or None
+
+    """
+    import uploads
+
+    session = uploads.UploadSession.get_by_id(int(session_id))
+    if session is None:
+        return None, utility.page_not_found(request)
+    page = models.Page.get_by_id(session.page_id)
+    if page is None or not page.user_can_write(request.profile):
+        return None, utility.forbidden(request)
+    return session, None
+
+
+def _json_response(data, status=200):
+    """Returns data encoded as a JSON response."""
+    response = http.HttpResponse(simplejson.dumps(data),
+                                 mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+def start_upload(request):
+    """Starts a resumable upload of an attachment.
+
+    The POST data has the page_id, the name of the file and hidden if the
+    file is not to be listed.  The response is JSON giving the id of the
+    upload session and the largest piece to send at a time.
+
+    """
+    import uploads
+
+    if not request.POST or not request.POST.get('page_id', '').isdigit():
+        return utility.page_not_found(request)
+    page = models.Page.get_by_id(int(request.POST['page_id']))
+    if not page:
+        return utility.page_not_found(request)
+    if not page.user_can_write(request.profile):
+        return utility.forbidden(request)
+
+    name = request.POST.get('name', '')
+    if not name or '/' in name:
+        return http.HttpResponseBadRequest('Invalid file name')
+    session = uploads.start_session(page, name, 'hidden' in request.POST)
+    return _json_response({'session': session.key().id(),
+                           'chunk_size': uploads.CHUNK_SIZE,
+                           'received': 0})
+
+
+def upload_chunk(request, session_id):
+    """Adds a piece of a file to a resumable upload.
+
+    A GET returns how many bytes have been received.  A POST sends the piece
+    as the file field chunk, with its byte offset in the file as offset.  Both
+    answer with JSON giving the number of bytes received, which is the offset
+    to send next; a POST at any other offset is ignored with a 409 status.
+
+    """
+    import uploads
+
+    session, error = _upload_session(request, session_id)
+    if error:
+        return error
+    if not request.POST:
+        return _json_response({'received': session.received})
+
+    try:
+        offset = int(request.POST['offset'])
+    except (KeyError, ValueError):
+        return http.HttpResponseBadRequest('Invalid offset')
+    if 'chunk' not in request.FILES:
+        return http.HttpResponseBadRequest('No chunk')
+    data = request.FILES['chunk'].read()
+
+    received = uploads.append(session.key(), offset, data)
+    status = 200
+    if received != offset + min(len(data), uploads.CHUNK_SIZE):
+        status = 409
+    return _json_response({'received': received}, status)
+
+
+def finish_upload(request, session_id):
+    """Attaches the file of a completed resumable upload to its page.
+
+    The response is JSON giving the path of the attachment.
+
+    """
+    import uploads
+
+    session, error = _upload_session(request, session_id)
+    if error:
+        return error
+    if not request.POST:
+        return _json_response({'received': session.received})
+
+    file_record = uploads.finish(session)
+    if file_record is None:
+        return utility.page_not_found(request)
+    return _json_response({'path': file_record.path})
+
+
 def delete_file(request, page_id, file_id):
     """Removes a specified file from the database.
 
@@ -374,6 +568,66 @@ def delete_page(request, page_id):
     return http.HttpResponseRedirect(url)
 
 
+def move_page(request, page_id):
+    """Moves a page, with everything beneath it, and/or renames it.
+
+    Args:
+        request: The request object
+        page_id: Key id of the page to move
+
+    Returns:
+        A Django HttpResponse object.
+
+    """
+    page = models.Page.get_by_id(int(page_id))
+    if not page or page.is_root:
+        return utility.page_not_found(request)
+    if not page.user_can_write(request.profile):
+        return utility.forbidden(request)
+
+    site = snapshot.current()
+    moving = set([page.key().id()])
+    moving.update(record.id for record in site.descendants(page.key().id())
+                  if record.kind == 'Page')
+    can_read = site.reader(request.profile)
+    parents = []
+    pending = [site.root]
+    while pending:
+        record = pending.pop()
+        if record is None or record.id in moving:
+            continue
+        if can_read(record):
+            parents.append(record)
+        pending.extend(reversed(record.children))
+
+    params = {'page': page, 'parents': parents,
+              'parent_id': page.parent_page.key().id(), 'name': page.name}
+    if not request.POST:
+        return utility.respond(request, 'admin/move_page', params)
+
+    params['name'] = request.POST.get('name', '')
+    parent = None
+    if request.POST.get('parent_id', '').isdigit():
+        parent = models.Page.get_by_id(int(request.POST['parent_id']))
+    if parent is None:
+        params['error_message'] = 'No such parent page.'
+    elif not parent.user_can_write(request.profile):
+        return utility.forbidden(request)
+    else:
+        params['parent_id'] = parent.key().id()
+        try:
+            moves.move_page(page, parent, params['name'])
+        except moves.MoveError, err:
+            params['error_message'] = unicode(err)
+        except exceptions.ValidationError, err:
+            params['error_message'] = u' '.join(err.messages)
+    if 'error_message' in params:
+        return utility.respond(request, 'admin/move_page', params)
+
+    return utility.edit_updated_page(page.key().id(),
+                                     message_id='msgChangesSaved')
+
+
 @super_user_required
 def download_page_html(request, page_id):
     """Gives users access to the current html content of a page.
@@ -394,9 +648,35 @@ def download_page_html(request, page_id):
     return response
 
 
+def _listing_page(request, read_page, *args):
+    """Reads the page of a listing given by the cursor and size parameters.
+
+    Args:
+        request: The request object
+        read_page: one of the page functions of listings
+        args: arguments to read_page before the cursor and size
+
+    Returns:
+        A dict with the rows of the page, and the URL of the next page if
+        there is one, to pass to the template.
+
+    """
+    import listings
+
+    size = listings.page_size(request.GET.get('size'))
+    rows, cursor = read_page(*(args + (request.GET.get('cursor'), size)))
+    params = {'rows': rows}
+    if cursor:
+        query = {'cursor': cursor}
+        if 'size' in request.GET:
+            query['size'] = size
+        params['next_url'] = '%s?%s' % (request.path, urllib.urlencode(query))
+    return params
+
+
 @super_user_required
 def filter_users(request):
-    """Lists all the UserGroups in the DB to filter the user list.
+    """Lists the UserGroups in the DB, a page at a time, to filter users.
 
     Args:
         request: The request object
@@ -405,13 +685,15 @@ def filter_users(request):
         A Django HttpResponse object.
 
     """
-    groups = models.UserGroup.all().order('name')
-    return utility.respond(request, 'admin/filter_users', {'groups': groups})
+    import listings
+
+    return utility.respond(request, 'admin/filter_users',
+                           _listing_page(request, listings.groups_page))
 
 
 @super_user_required
 def list_groups(request):
-    """Lists all the UserGroups in the DB for editing.
+    """Lists the UserGroups in the DB for editing, a page at a time.
 
     Args:
         request: The request object
@@ -420,30 +702,35 @@ def list_groups(request):
         A Django HttpResponse object.
 
     """
-    groups = models.UserGroup.all().order('name')
-    return utility.respond(request, 'admin/list_groups', {'groups': groups})
+    import listings
+
+    return utility.respond(request, 'admin/list_groups',
+                           _listing_page(request, listings.groups_page))
 
 
 @super_user_required
 def view_group(request, group_id):
-    """Lists all the UserProfiles in a group.
+    """Lists the UserProfiles in a group, or all of them, a page at a time.
 
     Args:
         request: The request object
-        group_id: Id of the group to display
+        group_id: Id of the group to display, or None for every user
 
     Returns:
         A Django HttpResponse object.
 
     """
-    users = models.UserProfile.all().order('email')
-    if group_id:
-        group = models.UserGroup.get_by_id(int(group_id))
-        if group.users:
-            users = models.UserProfile.get(group.users)
-        else:
-            users = []
-    return utility.respond(request, 'admin/view_group', {'users': users})
+    import listings
+
+    if not group_id:
+        return utility.respond(request, 'admin/view_group',
+                               _listing_page(request, listings.users_page))
+    group = models.UserGroup.get_by_id(int(group_id))
+    if group is None:
+        return utility.page_not_found(request)
+    params = _listing_page(request, listings.members_page, group)
+    params['group'] = group
+    return utility.respond(request, 'admin/view_group', params)
 
 
 @super_user_required
@@ -461,11 +748,7 @@ def add_to_group(_request, group_id, email):
     """
     group = models.UserGroup.get_by_id(int(group_id))
     user_key = models.UserProfile.load(email).key()
-    if group.users is None:
-        group.users = []
-        logging.warning('Group "%s" had a None users list', group.name)
-    group.users.append(user_key)
-    group.put()
+    group.add_members([user_key])
 
     url = urlresolvers.reverse('views.admin.edit_user', args=[email])
     return http.HttpResponseRedirect(url)
@@ -486,11 +769,7 @@ def remove_from_group(_request, group_id, email):
     """
     group = models.UserGroup.get_by_id(int(group_id))
     user_key = models.UserProfile.load(email).key()
-    if group.users is None:
-        group.users = []
-        logging.warning('Group "%s" had a None users list' % group.name)
-    group.users.remove(user_key)
-    group.put()
+    group.remove_members([user_key])
 
     url = urlresolvers.reverse('views.admin.edit_user', args=[email])
     return http.HttpResponseRedirect(url)
@@ -522,6 +801,8 @@ def edit_group(request, group_id):
         A Django HttpResponse object.
 
     """
+    import forms
+
     group = None
     if group_id:
         group = models.UserGroup.get_by_id(int(group_id))
@@ -562,6 +843,8 @@ def edit_user(request, email):
         A Django HttpResponse object.
 
     """
+    import forms
+
     if not email:
         if request.POST and request.POST['email']:
             url = urlresolvers.reverse('views.admin.edit_user',
@@ -593,6 +876,9 @@ def bulk_edit_users(request):
         A Django HttpResponse object.
 
     """
+    import csv
+    import StringIO
+
     if not request.POST:
         title = translation.ugettext('Bulk user upload form')
         return utility.respond(request, 'admin/bulk_edit_users',
@@ -608,11 +894,27 @@ def bulk_edit_users(request):
     if 'complete' in request.POST:
         for profile in models.UserProfile.all():
             db.delete(profile)
+        models.GroupMembership.delete_all(
+                models.GroupMembership.all(keys_only=True))
 
+    # Any columns after is_superuser name groups to add the user to.
+    groups = dict((group.name, group) for group in models.UserGroup.all_groups())
+    new_members = {}
     csv_buffer = StringIO.StringIO(data)
-    for email, is_superuser in csv.reader(csv_buffer, skipinitialspace=True):
-        if not models.UserProfile.update(email, is_superuser == '1'):
+    for row in csv.reader(csv_buffer, skipinitialspace=True):
+        email, is_superuser, group_names = row[0], row[1], row[2:]
+        profile = models.UserProfile.update(email, is_superuser == '1')
+        if not profile:
             logging.warning('Could not update user %r' % email)
+            continue
+        for name in group_names:
+            if name in groups:
+                new_members.setdefault(name, []).append(profile.key())
+            else:
+                logging.warning('No group %r for user %r' % (name, email))
+
+    for name, user_keys in new_members.iteritems():
+        groups[name].add_members(user_keys)
 
     url = urlresolvers.reverse('views.admin.index')
     return http.HttpResponseRedirect(url)
@@ -671,22 +973,24 @@ def edit_sidebar(request):
         A Django HttpResponse object.
 
     """
+    import yaml
+
     sidebar = models.Sidebar.load()
 
     if request.POST and 'yaml' in request.POST:
         yaml_data = request.POST['yaml']
         if not sidebar:
-            sidebar = models.Sidebar(yaml=yaml_data)
+            sidebar = models.Sidebar.create(yaml_data)
         else:
             sidebar.yaml = yaml_data
 
         error_message = None
         try:
             sidebar.put()
-        except yaml.YAMLError:
-            error_message = 'Invalid YAML'
         except KeyError, error:
             error_message = 'Invalid YAML, missing key %s' % error
+        except (yaml.YAMLError, TypeError, ValueError):
+            error_message = 'Invalid YAML'
 
         if error_message:
             return utility.respond(request, 'admin/edit_sidebar',
@@ -702,6 +1006,85 @@ def edit_sidebar(request):
         return utility.respond(request, 'admin/edit_sidebar', {'yaml': yaml_data})
 
 
+@super_user_required
+def rebuild_search_index(_request):
+    """Starts reindexing every page in the background.
+
+    Args:
+        _request: The request object (ignored)
+
+    Returns:
+        A Django HttpResponse object.
+
+    """
+    from google.appengine.api import taskqueue
+
+    taskqueue.add(url=urlresolvers.reverse('views.tasks.reindex_search'))
+    return http.HttpResponseRedirect(urlresolvers.reverse('views.admin.index'))
+
+
+@admin_required
+def list_migrations(request):
+    """Shows the progress of each migration and starts them.
+
+    A POST with the name of a migration starts it from the beginning, as a
+    dry run if dry_run is set.
+
+    Args:
+        request: The request object
+
+    Returns:
+        A Django HttpResponse object.
+
+    """
+    import migrations
+    # Imported so that the migrations they define are registered.
+    import autocomplete  # pylint: disable-msg=W0611
+    import backfills  # pylint: disable-msg=W0611
+
+    if request.POST:
+        try:
+            migrations.start(request.POST.get('name'),
+                             dry_run='dry_run' in request.POST)
+        except KeyError:
+            return utility.page_not_found(request, 'No such migration.')
+        return http.HttpResponseRedirect(
+                urlresolvers.reverse('views.admin.list_migrations'))
+
+    return utility.respond(request, 'admin/migrations',
+                           {'migrations': migrations.all_migrations()})
+
+
+def lookup(request):
+    """Returns the users or groups matching what has been typed, as JSON.
+
+    The GET parameters are kind, either user or group, and q, the start of the
+    email address or group name.  Superusers can look up anyone; other users
+    have to give the page_id of a page they can edit the security of.
+
+    Args:
+        request: The request object
+
+    Returns:
+        A Django HttpResponse object.
+
+    """
+    import autocomplete
+
+    if not request.profile:
+        return utility.forbidden(request)
+    if not request.profile.is_superuser:
+        page_id = request.GET.get('page_id', '')
+        page = page_id.isdigit() and models.Page.get_by_id(int(page_id))
+        if not page or not page.user_can_write(request.profile):
+            return utility.forbidden(request)
+
+    kind = request.GET.get('kind', 'user')
+    if kind not in autocomplete.KINDS:
+        return http.HttpResponseBadRequest('Unknown kind')
+    return _json_response(autocomplete.matches(kind, request.GET.get('q')))
+
+
 @admin_required
 def flush_memcache_info(_request):
     """Flushes the memcache.
@@ -729,6 +1112,9 @@ def display_memcache_info(request):
         A Django HttpResponse object.
 
     """
-    # pylint: disable-msg=E1101
+    import cachebackend
+
+    cache = cachebackend.current()
     return utility.respond(request, 'admin/memcache_info',
-                         {'memcache_info': memcache.get_stats()})
+                         {'cache_backend': cache.name,
+                          'memcache_info': cache.get_stats()})
@@ -17,15 +17,25 @@
 
 """Main views for viewing pages and downloading files."""
 
-import datetime
 import logging
 import mimetypes
+import time
+import urllib
 
+import cachepolicy
+import compression
 import configuration
+import counters
+import derivatives
 from django import http
 from django.core import urlresolvers
 from django.utils import simplejson
+from google.appengine.api import users
 import models
+import moves
+import search
+import snapshot
+import template_loader
 import utility
 
 
@@ -58,12 +68,23 @@ def send_page(page, request):
     item.icon = '/static/images/fileicons/%s.png' % ext
 
   is_editor = page.user_can_write(profile)
-
-  if configuration.SYSTEM_THEME_NAME:
-    template = 'themes/%s/page.html' % (configuration.SYSTEM_THEME_NAME)
-
-  return utility.respond(request, template, {'page': page, 'files': files,
-                                             'is_editor': is_editor})
+  counters.hit('Page', page.key().id())
+
+  theme = configuration.SYSTEM_THEME_NAME
+  holes = {}
+  for name in ('user_header', 'sidebar', 'edit_links'):
+    holes[name] = 'themes/%s/%s.html' % (theme, name)
+
+  response = utility.respond_with_holes(
+      request, 'themes/%s/page.html' % theme,
+      'page-body:%s:%s' % (theme, page.key().id()),
+      {'page': page, 'files': files}, holes, {'is_editor': is_editor})
+  record = snapshot.current().page(page.key().id())
+  if record is not None:
+    # The header and edit links differ once a user has signed in.
+    cachepolicy.set_headers(response, record, configuration.PAGE_CACHE_TIME,
+                            per_user=True, signed_in=request.user is not None)
+  return response
 
 
 def send_file(file_record, request):
@@ -85,10 +106,51 @@ def send_file(file_record, request):
                     (profile.email, file_record.name))
     return utility.forbidden(request)
 
-  expires = datetime.datetime.now() + configuration.FILE_CACHE_TIME
-  response = http.HttpResponse(content=file_record.data, mimetype=mimetype)
-  response['Cache-Control'] = configuration.FILE_CACHE_CONTROL
-  response['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
+  counters.hit('FileStore', file_record.key().id())
+
+  size = request.GET.get('size')
+  if size not in derivatives.SIZES:
+    size = None
+  webp = size is not None and derivatives.accepts_webp(request)
+
+  # The data is content-addressed, so its digest identifies each version.
+  etag = None
+  if file_record.digest:
+    etag = '"%s"' % '-'.join(
+        [file_record.digest] + [part for part in (size, webp and 'webp')
+                                if part])
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+      response = http.HttpResponseNotModified()
+      response['ETag'] = etag
+      return response
+
+  record = snapshot.current().file(file_record.key().id())
+  variant = derivatives.get_variant(file_record, mimetype, size, webp)
+  if variant is not None:
+    response = http.HttpResponse(content=variant.data,
+                                 mimetype=variant.mimetype)
+    response['Vary'] = 'Accept'
+    if record is not None:
+      cachepolicy.set_headers(response, record,
+                              configuration.VARIANT_CACHE_TIME)
+    if etag:
+      response['ETag'] = etag
+    return response
+
+  # Compressed files go out as stored to clients that can decompress them.
+  data, content_encoding = file_record.encoded_data()
+  if content_encoding and not compression.accepts_gzip(request):
+    data = compression.decompress(data)
+
+  response = http.HttpResponse(content=data, mimetype=mimetype)
+  if content_encoding:
+    response['Vary'] = 'Accept-Encoding'
+    if compression.accepts_gzip(request):
+      response['Content-Encoding'] = content_encoding
+  if record is not None:
+    cachepolicy.set_headers(response, record, configuration.FILE_CACHE_TIME)
+  if etag:
+    response['ETag'] = etag
   return response
 
 
@@ -104,38 +166,36 @@ def get_url(request, path_str):
     message.
 
   """
-  def follow_url_forwards(base, path):
-    """Follow the path forwards, returning the desired item."""
-    if not base:
-      return None
-    if not path:
-      utility.memcache_set('path:%s' % path_str, base)
-      return base
-    if len(path) == 1:
-      attachment = base.get_attachment(path[0])
-      if attachment:
-        return attachment
-    return follow_url_forwards(base.get_child(path[0]), path[1:])
-
-  def follow_url_backwards(pre_path, post_path):
-    """Traverse the path backwards to find a cached page or the root."""
-    key = 'path:' + '/'.join(pre_path)
-    item = utility.memcache_get(key)
-    if item:
-      return follow_url_forwards(item, post_path)
-    if not pre_path:
-      return follow_url_forwards(models.Page.get_root(), post_path)
-    return follow_url_backwards(pre_path[:-1], [pre_path[-1]] + post_path)
-
-  path = [dir_name for dir_name in path_str.split('/') if dir_name]
-  item = follow_url_backwards(path, [])
-
-  if isinstance(item, models.Page):
-    return send_page(item, request)
-
-  if isinstance(item, models.FileStore):
-    return send_file(item, request)
-
+  path_key = '/'.join(dir_name for dir_name in path_str.split('/') if dir_name)
+
+  # Reject paths that cannot exist before doing any datastore work.
+  record = snapshot.current().resolve(path_key)
+  if record is None:
+    target = moves.redirect_target(path_key)
+    if target is not None:
+      return http.HttpResponsePermanentRedirect(target)
+    return utility.page_not_found(request)
+  missing_key = 'missing-path:%s' % path_key
+  if utility.memcache_get(missing_key):
+    return utility.page_not_found(request)
+
+  if isinstance(record, snapshot.PageRecord):
+    key = 'path:%s' % path_key
+    page = utility.memcache_get(key)
+    if not page:
+      page = models.Page.get_by_id(record.id)
+      if page:
+        page.resolve_references()
+      utility.memcache_set(key, page)
+    if page:
+      return send_page(page, request)
+  else:
+    file_record = models.FileStore.get_by_id(record.id)
+    if file_record:
+      return send_file(file_record, request)
+
+  utility.memcache_set(missing_key, True,
+                       expires=configuration.MISSING_PATH_CACHE_TIME)
   return utility.page_not_found(request)
 
 
@@ -149,10 +209,20 @@ def get_tree_data(request):
     A Django HttpResponse object containing the file data.
 
   """
+  # The tree only depends on what the user can read, which only changes when
+  # the cache is cleared.
+  profile = request.profile
+  key = 'treedata:%s' % (profile and profile.key().id() or 'anonymous')
+  content = utility.memcache_get(key)
+  if content is not None:
+    return utility.cache_compressed(http.HttpResponse(content))
+
+  site = snapshot.current()
+  can_read = site.reader(profile)
 
   def get_node_data(page):
     """A recursive function to output individual nodes of the tree."""
-    page_id = str(page.key().id())
+    page_id = str(page.id)
     data = {'title': page.title,
             'path': page.path,
             'id': page_id,
@@ -163,18 +233,88 @@ def get_tree_data(request):
             'delete_url': urlresolvers.reverse(
                 'views.admin.delete_page', args=[page_id])}
     children = []
-    for child in page.page_children:
-      if child.acl.user_can_read(request.profile):
+    for child in page.children:
+      if can_read(child):
         children.append(get_node_data(child))
     if children:
       data['children'] = children
     return data
 
-  data = {'identifier': 'id', 'label': 'title',
-          'items': [get_node_data(models.Page.get_root())]}
-  return http.HttpResponse(simplejson.dumps(data))
+  items = []
+  if site.root is not None:
+    items.append(get_node_data(site.root))
+  data = {'identifier': 'id', 'label': 'title', 'items': items}
+  content = simplejson.dumps(data)
+  utility.memcache_set(key, content)
+  return utility.cache_compressed(http.HttpResponse(content))
+
+
+def search_pages(request):
+  """Searches the titles and content of the pages the user can read.
+
+  Args:
+    request: The Django request object
+
+  Returns:
+    A Django HttpResponse containing a page of search results.
+
+  """
+  query = request.GET.get('q', '')
+  try:
+    page_number = max(int(request.GET.get('p', 0)), 0)
+  except ValueError:
+    page_number = 0
+
+  results, total = search.search(query, request.profile, page_number)
+
+  def results_url(number):
+    """Returns the URL of another page of results for the same query."""
+    return '%s?%s' % (urlresolvers.reverse('views.main.search_pages'),
+                      urllib.urlencode({'q': query.encode('utf-8'),
+                                        'p': number}))
+
+  params = {'query': query, 'results': results, 'total': total}
+  if page_number > 0:
+    params['previous_url'] = results_url(page_number - 1)
+  if (page_number + 1) * search.RESULTS_PER_PAGE < total:
+    params['next_url'] = results_url(page_number + 1)
+  return utility.respond(request, 'search', params)
 
 
 def page_list(request):
   """List all pages."""
   return utility.respond(request, 'sitemap')
+
+
+def warmup(_request):
+  """Prepares a new instance before it receives user traffic.
+
+  App Engine requests /_ah/warmup on instances it starts ahead of demand.  The
+  URLconf is resolved (which imports every view module), the templates of
+  every theme are compiled and the site snapshot, root page and anonymous
+  sidebar are primed.
+
+  Args:
+    _request: The Django request object (ignored)
+
+  Returns:
+    A plain text HttpResponse listing the time taken by each step.
+
+  """
+  steps = [
+      ('urlconf', lambda: urlresolvers.reverse('views.main.get_url',
+                                               args=[''])),
+      ('templates', template_loader.precompile),
+      ('snapshot', snapshot.current),
+      ('root page', models.Page.get_root),
+      ('sidebar', lambda: models.Sidebar.render(None)),
+  ]
+
+  timings = []
+  for name, step in steps:
+    start = time.time()
+    step()
+    timings.append('%s: %.0f ms' % (name, (time.time() - start) * 1000))
+
+  logging.info('Warmup finished: %s', ', '.join(timings))
+  return http.HttpResponse('\n'.join(timings), mimetype='text/plain')
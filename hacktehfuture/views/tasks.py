@@ -0,0 +1,175 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Views run by the task queue.
+
+The /_tasks/ URLs are restricted to administrators in app.yaml, which also
+admits requests made by the task queue itself.
+
+"""
+
+from django import http
+from django.core import urlresolvers
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+# Imported so that the migrations they define are registered.
+import autocomplete  # pylint: disable-msg=W0611
+import backfills  # pylint: disable-msg=W0611
+import configuration
+import counters
+import migrations
+import models
+import moves
+import search
+import uploads
+
+
+def reindex_search(request):
+  """Indexes one batch of pages and queues a task for the next batch.
+
+  Args:
+    request: The Django request object, with the cursor to continue from
+        in the POST data, or page_ids, the comma-separated ids of the saved
+        or deleted pages to update
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  page_ids = request.POST.get('page_ids')
+  if page_ids:
+    search.update_pages([int(page_id) for page_id in page_ids.split(',')])
+    return http.HttpResponse('OK', mimetype='text/plain')
+
+  next_cursor = search.reindex_batch(request.POST.get('cursor'))
+  if next_cursor:
+    taskqueue.add(url=urlresolvers.reverse('views.tasks.reindex_search'),
+                  params={'cursor': next_cursor})
+  return http.HttpResponse('OK', mimetype='text/plain')
+
+
+def run_migration(request):
+  """Runs one batch of a migration, which queues the next batch itself.
+
+  Args:
+    request: The Django request object, with the name of the migration and
+        the id of the run in the POST data
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  status = migrations.run_batch(request.POST['name'],
+                                request.POST.get('run_id'))
+  if status is None:
+    return http.HttpResponse('Not the current run', mimetype='text/plain')
+  return http.HttpResponse('Processed %d, changed %d' %
+                           (status.processed, status.changed),
+                           mimetype='text/plain')
+
+
+def journal_move(request):
+  """Journals one batch of a moved subtree and queues the next batch.
+
+  Args:
+    request: The Django request object, with the id of the moved page and
+        the offset to continue from in the POST data
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  page_id = int(request.POST['page_id'])
+  offset = moves.journal_subtree(page_id, int(request.POST.get('offset', 0)))
+  if offset is not None:
+    taskqueue.add(url=urlresolvers.reverse('views.tasks.journal_move'),
+                  params={'page_id': page_id, 'offset': offset})
+  return http.HttpResponse('OK', mimetype='text/plain')
+
+
+def discard_uploads(_request):
+  """Deletes resumable uploads that were never finished.
+
+  Args:
+    _request: The Django request object (ignored)
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  count = uploads.discard_expired()
+  if count:
+    taskqueue.add(url=urlresolvers.reverse('views.tasks.discard_uploads'))
+  return http.HttpResponse('Discarded %d uploads' % count,
+                           mimetype='text/plain')
+
+
+def migrate_group_members(_request):
+  """Moves group members still listed in UserGroup.users into memberships.
+
+  Args:
+    _request: The Django request object (ignored)
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  count = 0
+  for group in models.UserGroup.all():
+    if group.users:
+      group.migrate_members()
+      count += 1
+  return http.HttpResponse('Migrated %d groups' % count, mimetype='text/plain')
+
+
+def purge_cache(request):
+  """Tells the proxy in front of the site which responses to drop.
+
+  The keys are sent in a Surrogate-Key header, as cachepolicy puts them on
+  responses.  A failed purge raises so that the task queue retries it.
+
+  Args:
+    request: The Django request object, with the space separated surrogate
+        keys in the POST data
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  keys = request.POST.get('keys', '')
+  if configuration.PURGE_URL and keys:
+    result = urlfetch.fetch(configuration.PURGE_URL, method=urlfetch.POST,
+                            headers={'Surrogate-Key': keys},
+                            follow_redirects=False)
+    if result.status_code >= 300:
+      raise urlfetch.Error('Purge failed with status %d' % result.status_code)
+  return http.HttpResponse('OK', mimetype='text/plain')
+
+
+def flush_counters(_request):
+  """Moves pending view and download counts into the datastore.
+
+  Args:
+    _request: The Django request object (ignored)
+
+  Returns:
+    A Django HttpResponse
+
+  """
+  count = counters.flush()
+  return http.HttpResponse('Flushed %d counters' % count,
+                           mimetype='text/plain')